@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+# Generates a synthetic use folder, to benchmark use with configurations much bigger than a real one.
+#
+# Usage: generate_config.py <folder> [--targets N] [--chain-depth N] [--diamonds N] [--include-depth N]
+#                                    [--generics N] [--list-length N]
+#
+# The folder gets a targets.json, a default.json, target jsons and posix/*.source scripts with:
+#  - leaf-<i>: plain .source scripts, most of the targets
+#  - chain-<i>: each one uses the previous one, for deep dependency chains
+#  - diamond-<i>: uses two targets which both use the same leaf
+#  - gen<i>-%: generic json targets, which use a leaf and include inc-0.json
+#  - inc-<i>.json: includes inc-<i+1>.json, for nested includes
+#  - lists: a json target with long list-valued variables
+#  - bench-top: uses the end of the chain, all diamonds, a generic target and lists
+#  - hidden-<i>: a few hidden targets, which completion must skip
+
+import argparse
+import json
+import os
+import sys
+
+
+def write(filename, contents):
+    with open(filename, 'w') as f:
+        f.write(contents)
+
+
+def write_json(filename, decoded):
+    write(filename, json.dumps(decoded, indent=1))
+
+
+def generate(folder, args):
+    posix = os.path.join(folder, 'posix')
+    os.makedirs(posix, exist_ok=True)
+
+    targets = []
+
+    def add_script_target(name, uses=None):
+        target = {'name': name}
+        if uses:
+            target['uses'] = uses
+        targets.append(target)
+        write(os.path.join(posix, name + '.source'),
+              'export {0}_HOME=/opt/{1}\nexport PATH=/opt/{1}/bin:$PATH\n'.format(name.upper().replace('-', '_'), name))
+
+    write_json(os.path.join(folder, 'default.json'), {'any': [{'USE_BENCHMARK': '1'}]})
+
+    leaves = max(1, args.targets - args.chain_depth - 3 * args.diamonds - args.generics - 8)
+    for i in range(leaves):
+        add_script_target('leaf-{}'.format(i))
+
+    for i in range(args.chain_depth):
+        add_script_target('chain-{}'.format(i), ['chain-{}'.format(i - 1)] if i else ['leaf-0'])
+
+    diamonds = []
+    for i in range(args.diamonds):
+        shared = 'leaf-{}'.format(i % leaves)
+        add_script_target('diamond-{}-left'.format(i), [shared])
+        add_script_target('diamond-{}-right'.format(i), [shared])
+        add_script_target('diamond-{}'.format(i), ['diamond-{}-left'.format(i), 'diamond-{}-right'.format(i)])
+        diamonds.append('diamond-{}'.format(i))
+
+    for i in range(args.include_depth):
+        decoded = {'any': [{'INC_{}'.format(i): '${HOME}/inc-' + str(i)}]}
+        if i + 1 < args.include_depth:
+            decoded['includes'] = ['${USE_TARGETS_FOLDER}/inc-' + str(i + 1) + '.json']
+        write_json(os.path.join(folder, 'inc-{}.json'.format(i)), decoded)
+
+    for i in range(args.generics):
+        name = 'gen{}-%'.format(i)
+        targets.append({'name': name, 'uses': ['leaf-{}'.format(i % leaves)]})
+        decoded = {'description': 'Generic ' + str(i),
+                   'posix': [{'GEN{}_DIR'.format(i): '/opt/gen{}/USE_ARG'.format(i)},
+                             {'PATH': ['/opt/gen{}/USE_ARG/bin'.format(i), '${PATH}']}],
+                   'any': [{'GEN{}_ARG'.format(i): 'USE_ARG'}]}
+        if args.include_depth:
+            decoded['includes'] = ['${USE_TARGETS_FOLDER}/inc-0.json']
+        write_json(os.path.join(folder, name + '.json'), decoded)
+
+    targets.append({'name': 'lists'})
+    write_json(os.path.join(folder, 'lists.json'), {
+        'posix': [{'PATH': ['/opt/lists/{}/bin'.format(i) for i in range(args.list_length)] + ['${PATH}']},
+                  {'LD_LIBRARY_PATH': ['/opt/lists/{}/lib'.format(i) for i in range(args.list_length)] +
+                   ['${LD_LIBRARY_PATH}']},
+                  {'CMAKE_PREFIX_PATH': ['/opt/lists/{}'.format(i % (args.list_length // 2 + 1))
+                                         for i in range(args.list_length)]}]})
+
+    for i in range(3):
+        targets.append({'name': 'hidden-{}'.format(i), 'hidden': True})
+        write(os.path.join(posix, 'hidden-{}.source'.format(i)), 'export HIDDEN={}\n'.format(i))
+
+    uses = diamonds + ['lists']
+    if args.chain_depth:
+        uses.append('chain-{}'.format(args.chain_depth - 1))
+    if args.generics:
+        uses.append('gen0-1.0')
+    targets.append({'name': 'bench-top', 'uses': uses})
+    write(os.path.join(posix, 'bench-top.source'), 'export BENCH_TOP=1\n')
+
+    write_json(os.path.join(folder, 'targets.json'), {'targets': targets})
+    return len(targets)
+
+
+def add_arguments(parser):
+    parser.add_argument('--targets', type=int, default=2000)
+    parser.add_argument('--chain-depth', type=int, default=50)
+    parser.add_argument('--diamonds', type=int, default=20)
+    parser.add_argument('--include-depth', type=int, default=5)
+    parser.add_argument('--generics', type=int, default=100)
+    parser.add_argument('--list-length', type=int, default=200)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates a synthetic use folder')
+    parser.add_argument('folder')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    count = generate(args.folder, args)
+    print('Generated {} targets in {}'.format(count, args.folder))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+# Times use's entry points against a synthetic configuration, and reports the results as JSON,
+# so changes to the loader and resolver can be compared run over run.
+#
+# Usage: run.py [--folder <use folder>] [--runs N] [--target <name>] [--output <file>] [generator options]
+#
+# Without --folder, a configuration is generated into a temporary folder, see generate_config.py for the options.
+# Each scenario is timed with caching disabled ("cold") and with a cache filled by a first run ("warm").
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+
+import generate_config
+from startup import USE_PY, time_command
+
+
+def scenarios(target):
+    return [
+        ('completion', ['--bash-autocomplete-helper', 'leaf-1']),
+        ('no-arg', []),
+        ('prompt', ['--prompt']),
+        ('print', [target, '--print']),
+        ('print-to-file', [target, '--print-to-file']),
+        ('command', [target, '--command=true']),
+    ]
+
+
+def run_scenario(arguments, env, runs):
+    command = [sys.executable, USE_PY] + arguments
+    returncode = subprocess.run(command, env=env, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+    timings = time_command(command, env, runs)
+    return {'median_ms': round(statistics.median(timings), 2),
+            'mean_ms': round(statistics.mean(timings), 2),
+            'min_ms': round(min(timings), 2),
+            'max_ms': round(max(timings), 2),
+            'runs': runs,
+            'returncode': returncode}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks use against a synthetic configuration')
+    parser.add_argument('--folder', default='', help='use folder to benchmark, generated if not given')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--target', default='bench-top')
+    parser.add_argument('--output', default='', help='write the JSON here instead of stdout')
+    generate_config.add_arguments(parser)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='use-benchmark-') as tmp:
+        folder = args.folder
+        if not folder:
+            folder = os.path.join(tmp, 'use_scripts')
+            generate_config.generate(folder, args)
+
+        base_env = {'PATH': os.getenv('PATH', '/usr/bin:/bin'), 'HOME': tmp, 'SHELL': os.getenv('SHELL', '/bin/bash'),
+                    'USE_FOLDER': os.path.abspath(folder)}
+
+        results = {}
+        for (cache, cache_folder) in [('cold', ''), ('warm', os.path.join(tmp, 'cache'))]:
+            env = dict(base_env)
+            env['USE_CACHE_FOLDER'] = cache_folder
+            results[cache] = {}
+            for (name, arguments) in scenarios(args.target):
+                results[cache][name] = run_scenario(arguments, env, args.runs)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'folder': args.folder or 'generated',
+        'target': args.target,
+        'generator': {} if args.folder else {
+            'targets': args.targets, 'chain_depth': args.chain_depth, 'diamonds': args.diamonds,
+            'include_depth': args.include_depth, 'generics': args.generics, 'list_length': args.list_length},
+        'results': results,
+    }
+
+    contents = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(contents + '\n')
+    else:
+        print(contents)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# Measures how long use.py takes to start, compared to a bare python interpreter.
+# Every scenario runs in a fresh process, so imports and module level work are part of the measurement.
+#
+# Usage: startup.py [--runs N] [--target <name>] [--max-overhead-ms <ms>]
+#
+# With --max-overhead-ms, exits with 1 if the completion helper, the no-arg query or --prompt take longer than that
+# on top of the bare interpreter, so cold-start regressions can be caught in a script.
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+USE_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'use.py')
+
+
+def time_command(command, env, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, stdin=subprocess.DEVNULL,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold-start benchmark for use.py')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--target', default='', help='also time --plan and --print for this target')
+    parser.add_argument('--max-overhead-ms', type=float, default=0)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.pop('USE_CURRENT_TARGETS', None)
+
+    scenarios = [
+        ('python', [sys.executable, '-c', 'pass']),
+        ('completion', [sys.executable, USE_PY, '--bash-autocomplete-helper', '']),
+        ('no-arg', [sys.executable, USE_PY]),
+        ('prompt', [sys.executable, USE_PY, '--prompt']),
+    ]
+    if args.target:
+        scenarios.append(('plan', [sys.executable, USE_PY, args.target, '--plan']))
+        scenarios.append(('print', [sys.executable, USE_PY, args.target, '--print']))
+
+    # Warm up the completion index and the caches, the interesting number is the steady state
+    for (_, command) in scenarios:
+        time_command(command, env, 1)
+
+    medians = {}
+    print('{:<12} {:>10} {:>10}'.format('scenario', 'median ms', 'min ms'))
+    for (name, command) in scenarios:
+        timings = time_command(command, env, args.runs)
+        medians[name] = statistics.median(timings)
+        print('{:<12} {:>10.1f} {:>10.1f}'.format(name, medians[name], min(timings)))
+
+    if args.max_overhead_ms:
+        for name in ['completion', 'no-arg', 'prompt']:
+            overhead = medians[name] - medians['python']
+            if overhead > args.max_overhead_ms:
+                print('{} takes {:.1f} ms more than a bare interpreter, the limit is {} ms'.format(
+                    name, overhead, args.max_overhead_ms))
+                return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,41 @@
+# Shows the active targets in the prompt without starting python, source it from your .bashrc or .zshrc:
+#   source /path/to/use/niceties/prompt.sh
+#
+# Before each prompt USE_PROMPT is set to what "use --prompt" prints, "(target1 target2) ", or to nothing
+# if no target is active, and it's put in front of PS1. Set USE_PROMPT_NO_PS1=1 before sourcing to only get
+# the variable, and place ${USE_PROMPT} yourself.
+
+use_prompt_update() {
+    # USE_CURRENT_TARGETS looks like ";default;target1;target2", default is left out
+    local targets=";${USE_CURRENT_TARGETS};"
+    targets="${targets//;default;/;}"
+    while [[ "$targets" == *";;"* ]]; do
+        targets="${targets//;;/;}"
+    done
+    targets="${targets#;}"
+    targets="${targets%;}"
+
+    if [[ -n "$targets" ]]; then
+        USE_PROMPT="(${targets//;/ }) "
+    else
+        USE_PROMPT=""
+    fi
+}
+
+if [[ -n "$ZSH_VERSION" ]]; then
+    autoload -Uz add-zsh-hook
+    add-zsh-hook precmd use_prompt_update
+    if [[ "$USE_PROMPT_NO_PS1" != "1" && "$PS1" != *'${USE_PROMPT}'* ]]; then
+        setopt PROMPT_SUBST
+        PS1='${USE_PROMPT}'"$PS1"
+    fi
+else
+    if [[ "$PROMPT_COMMAND" != *use_prompt_update* ]]; then
+        PROMPT_COMMAND="use_prompt_update${PROMPT_COMMAND:+;$PROMPT_COMMAND}"
+    fi
+    if [[ "$USE_PROMPT_NO_PS1" != "1" && "$PS1" != *'${USE_PROMPT}'* ]]; then
+        PS1='${USE_PROMPT}'"$PS1"
+    fi
+fi
+
+use_prompt_update
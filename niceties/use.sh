@@ -0,0 +1,19 @@
+# Shell integration for bash and zsh, source it from your .bashrc or .zshrc instead of using an alias:
+#   source /path/to/use/niceties/use.sh
+#
+# "use <target> --push" then applies the target to the current shell instead of opening a new one,
+# and "use --pop" goes back to how the env was before the last --push.
+# "use <target> --switch" replaces the pushed targets with target, only re-sourcing what differs.
+# Everything else is passed to use.py as usual.
+
+use() {
+    case " $* " in
+        *" --push "*|*" --pop "*|*" --switch "*)
+            local use_env_script
+            use_env_script="$(command use.py "$@")" && eval "$use_env_script"
+            ;;
+        *)
+            command use.py "$@"
+            ;;
+    esac
+}
@@ -2,19 +2,250 @@
 
 import sys
 import os
+
+POSSIBLE_SWITCHES = ['--keep', '--config', '--configure', '--edit', '--conf', '--help',
+                     '-h', '--bash-autocomplete-helper', '--debug', '--silent', '--print', '--print-to-file',
+                     '--plan', '--daemon', '--snapshot', '--warm', '--profile', '--push', '--pop',
+                     '--switch', '--prompt']
+
+
+def cache_folder():
+    # Set USE_CACHE_FOLDER to an empty string to disable all caching
+    return os.getenv('USE_CACHE_FOLDER', os.path.join(os.path.expanduser('~'), '.cache', 'use'))
+
+
+def use_folder_override():
+    # Points use to another folder with targets.json, for example a test or benchmark setup
+    return os.getenv('USE_FOLDER', '')
+
+
+def completion_index_filename():
+    folder = cache_folder()
+    if not folder:
+        return ""
+    return os.path.join(folder, 'completion.idx')
+
+
+def bash_autocomplete_word_beginning(args):
+    for a in args:
+        if a in POSSIBLE_SWITCHES or a.startswith('--command=') or a.startswith('--cwd=') or a.startswith('--ignore=') \
+                or a.startswith('--profile='):
+            continue
+        return a
+    return ""
+
+
+def bash_autocomplete_result(targetNames, wordBeginning):
+    result = [name for name in targetNames if name.startswith(wordBeginning)]
+
+    if wordBeginning.startswith('-'):
+        # Let's only spam the completion with switches if the user already typed -
+        result += [s for s in POSSIBLE_SWITCHES if s.startswith(wordBeginning)]
+
+    return ' '.join(result)
+
+
+# Tab completion runs on every keypress, so it's answered from a small index of the non-hidden
+# target names, before importing anything else or reading any configuration.
+# Returns False if the index is missing or outdated, in which case the slow path regenerates it.
+def bash_autocomplete_from_index():
+    try:
+        with open(completion_index_filename(), 'r') as f:
+            (use_folder, targets_json, stamp, names) = f.read().split('\n')[:4]
+        st = os.stat(targets_json)
+    except (OSError, ValueError):
+        return False
+
+    if use_folder != use_folder_override():
+        return False
+
+    if stamp != str(st.st_mtime_ns) + " " + str(st.st_size):
+        return False
+
+    print(bash_autocomplete_result(names.split(), bash_autocomplete_word_beginning(sys.argv[1:])))
+    return True
+
+
+if __name__ == '__main__' and '--bash-autocomplete-helper' in sys.argv and bash_autocomplete_from_index():
+    sys.exit(0)
+
+
+def currentTargets():
+    targets = os.getenv('USE_CURRENT_TARGETS')
+    if not targets:
+        return []
+    return targets.split(';')
+
+
+def currentTargetsStr():
+    return ' '.join(currentTargets())
+
+
+# What --prompt prints, for PS1: "(target1 target2) ", or nothing if no target is active.
+# default is left out, as every target sources it. niceties/prompt.sh does the same in shell code.
+def promptStr():
+    targets = [name for name in currentTargets() if name and name != 'default']
+    if not targets:
+        return ""
+    return "(" + ' '.join(targets) + ") "
+
+
+# Asking for the current targets runs on every prompt for some, it only needs USE_CURRENT_TARGETS,
+# so it's answered before importing anything else or reading any configuration
+if __name__ == '__main__' and len(sys.argv) == 1:
+    print(currentTargetsStr())
+    sys.exit(-1)
+
+if __name__ == '__main__' and sys.argv[1:] == ['--prompt']:
+    sys.stdout.write(promptStr())
+    sys.exit(0)
+
+# Only what most activations need is imported here, subprocess, socket, hashlib and friends
+# are imported by the functions using them, so the fast paths don't pay for them
 import json
-import platform
-import io
-import subprocess
-import string
 import re
+import atexit
+import time
+
+# Importing use has no side effects, the state of an invocation is set by start_invocation()
+_print_env_only = False
+_print_env_to_file = False
+
+# --profile records how long each phase takes, as Chrome trace events (open the file in https://ui.perfetto.dev)
+_profile_filename = ''
+_profile_events = []
+_profile_start = time.perf_counter()
+
+
+def profile_timestamp(t):
+    return round((t - _profile_start) * 1000000, 1)  # microseconds, as trace events expect
+
+
+class ProfileSpan:
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if _profile_filename:
+            _profile_events.append({'name': self.name, 'cat': self.category, 'ph': 'X',
+                                    'ts': profile_timestamp(self.start),
+                                    'dur': round((time.perf_counter() - self.start) * 1000000, 1),
+                                    'pid': os.getpid(), 'tid': 0, 'args': self.args})
+        return False
+
+
+class NoProfileSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
 
-_print_env_only = '--print' in sys.argv or '--print-to-file' in sys.argv
-_print_env_to_file = '--print-to-file' in sys.argv
+
+_no_profile_span = NoProfileSpan()
+
+
+def profile_span(name, category, **args):
+    if not _profile_filename:
+        return _no_profile_span
+    return ProfileSpan(name, category, args)
+
+
+def profile_instant(name, category, **args):
+    if _profile_filename:
+        _profile_events.append({'name': name, 'cat': category, 'ph': 'i', 's': 'p',
+                                'ts': profile_timestamp(time.perf_counter()),
+                                'pid': os.getpid(), 'tid': 0, 'args': args})
+
+
+# Writes the trace and prints a summary to stderr. Called at exit, and before the shell starts,
+# as that one can stay open for hours.
+def write_profile():
+    global _profile_filename
+
+    filename = _profile_filename
+    if not filename:
+        return
+    _profile_filename = ''
+
+    if not write_file_atomically(filename, json.dumps({'traceEvents': _profile_events, 'displayTimeUnit': 'ms'})):
+        print("Error writing " + filename, file=sys.stderr)
+        return
+
+    # Target spans contain the other phases, they're listed on their own
+    spans = [e for e in _profile_events if e['ph'] == 'X']
+    totals = {}
+    for e in spans:
+        if e['cat'] != 'target':
+            totals[e['cat']] = totals.get(e['cat'], 0) + e['dur']
+
+    print("Profile written to " + filename, file=sys.stderr)
+    print("Total: {:.1f} ms".format(profile_timestamp(time.perf_counter()) / 1000), file=sys.stderr)
+    for (category, total) in sorted(totals.items(), key=lambda item: -item[1]):
+        print("  {:<10} {:8.1f} ms".format(category, total / 1000), file=sys.stderr)
+
+    targets = sorted([e for e in spans if e['cat'] == 'target'], key=lambda e: -e['dur'])
+    if targets:
+        print("Slowest targets:", file=sys.stderr)
+        for e in targets[:5]:
+            print("  {:<30} {:8.1f} ms".format(e['args']['target'], e['dur'] / 1000), file=sys.stderr)
+
+
+# Platform facts don't change while we run, so they're computed once, and only when asked for
+class HostProfile:
+    # What platform.system() returns for them, anything else asks platform.system(), Cygwin's CYGWIN_NT-... included
+    SYSTEMS = {'win32': 'Windows', 'darwin': 'Darwin'}
+
+    def __init__(self):
+        if sys.platform.startswith('linux'):
+            self.system = 'Linux'
+        elif sys.platform in HostProfile.SYSTEMS:
+            self.system = HostProfile.SYSTEMS[sys.platform]
+        else:
+            import platform
+            self.system = platform.system()
+
+        self._machine = None
+        self._is_wsl = None
+
+    def machine(self):
+        if self._machine is None:
+            if hasattr(os, 'uname'):
+                self._machine = os.uname().machine
+            else:
+                import platform
+                self._machine = platform.machine()
+        return self._machine
+
+    def isWSL(self):
+        if self._is_wsl is None:
+            try:
+                with open('/proc/version', 'r') as f:
+                    self._is_wsl = 'microsoft' in f.read().lower()
+            except:
+                self._is_wsl = False
+        return self._is_wsl
+
+
+_host_profile = None
+
+
+def hostProfile():
+    global _host_profile
+    if _host_profile is None:
+        _host_profile = HostProfile()
+    return _host_profile
 
 
 def isWindows():
-    return platform.system() == "Windows"
+    return hostProfile().system == "Windows"
 
 
 def osType():  # returns 'nt' or 'posix'
@@ -25,15 +256,15 @@ def osType():  # returns 'nt' or 'posix'
 
 
 def platformNameWithArch():
-    plat = platform.system()
-    if plat == 'Darwin' and platform.machine() == 'arm64':
+    plat = hostProfile().system
+    if plat == 'Darwin' and hostProfile().machine() == 'arm64':
         return 'DarwinArm'
 
     return plat
 
 
 def platformName():  # returns 'Windows', 'Linux' or 'Darwin'
-    return platform.system()
+    return hostProfile().system
 
 
 def platformNameLowercase():
@@ -41,15 +272,11 @@ def platformNameLowercase():
 
 
 def isWSL():
-    try:
-        f = open('/proc/version', 'r')
-        return 'microsoft' in f.read().lower()
-    except:
-        return False
+    return hostProfile().isWSL()
 
 
 def isLinux():
-    return platform.system() == "Linux"
+    return hostProfile().system == "Linux"
 
 
 def isBash():
@@ -62,15 +289,54 @@ def usePlatform():  # returns 'windows' or 'posix'
     return 'posix'
 
 
-def fill_placeholders(value):
-    placeholders = re.findall('\\$\\{(.*?)\\}', value)  # searches for ${foo}
-    for placeholder in placeholders:
-        value = value.replace("${" + placeholder + "}", os.getenv(placeholder, ''))
+# A value with ${foo} placeholders, split once into literal chunks and the names of the variables between them
+class PlaceholderTemplate:
+    def __init__(self, text):
+        parts = re.split('\\$\\{(.*?)\\}', text)  # searches for ${foo}
+        self.text = text
+        self.literals = parts[0::2]
+        self.names = parts[1::2]
+        self.last_values = None
+        self.last_result = text
+
+    # The result is memoized while the referenced variables keep their values
+    def expand(self):
+        if not self.names:
+            return self.text
 
-    return value
+        _input_variables.update(self.names)
+        values = tuple(os.getenv(name, '') for name in self.names)
+        if values != self.last_values:
+            chunks = [self.literals[0]]
+            for (value, literal) in zip(values, self.literals[1:]):
+                chunks.append(value)
+                chunks.append(literal)
+            self.last_values = values
+            self.last_result = ''.join(chunks)
+
+        return self.last_result
+
+
+_placeholder_templates = {}
+
+
+def compile_placeholders(value):
+    template = _placeholder_templates.get(value)
+    if template is None:
+        template = PlaceholderTemplate(value)
+        _placeholder_templates[value] = template
+    return template
+
+
+def fill_placeholders(value):
+    return compile_placeholders(value).expand()
 
 
 def to_native_path(path):
+    global _depends_on_cwd
+    if not os.path.isabs(path):
+        _depends_on_cwd = True
+
     path = os.path.abspath(path)
     if path.endswith("\\") or (path.endswith('/') and path != '/'):
         path = path[:-1]
@@ -118,6 +384,7 @@ def to_unix_path(path):
 class UseConf:
     def __init__(self):
         self.use_targets_folder = ""
+        self.folder_override = use_folder_override()
 
         if not self.targetsFolder():
             print("Use folder not found!\nSet 'use_targets_folder' variable in ~/.use.conf, point it to your folder with env scripts.\n")
@@ -126,10 +393,10 @@ class UseConf:
             print("Configuration file not found!\nSet the env variable USES_LIST_FILE, point it to your json file.\n")
             sys.exit(-1)
 
-        os.environ['USE_TARGETS_FOLDER'] = self.useFolder()
-
     def useFolder(self):
-        if isLinux():
+        if self.folder_override:
+            return self.folder_override
+        elif isLinux():
             return '/data/windows-linux-shared/use_scripts'
         elif isWindows():
             return 'b:\\windows-linux-shared\\use_scripts'
@@ -137,33 +404,194 @@ class UseConf:
             return '/Users/serj/data/windows-linux-shared/use_scripts'
 
     def targetsFolder(self):
-        if isLinux():
-            return '/data/windows-linux-shared/use_scripts/posix'
-        elif isWindows():
-            return 'b:\\windows-linux-shared\\use_scripts\\windows'
-        else:
-            return '/Users/serj/data/windows-linux-shared/use_scripts/posix'
+        return os.path.join(self.useFolder(), usePlatform())
 
     def targetsJsonFilename(self):
         return self.useFolder() + '/targets.json'
 
 
-_use_conf = UseConf()
+def use_conf():
+    global _use_conf
+    if _use_conf is None:
+        _use_conf = UseConf()
+    return _use_conf
+
+
+# Writes to a temporary file first, so concurrent use invocations never read a half-written cache
+def write_file_atomically(filename, contents):
+    tmp_filename = filename + "." + str(os.getpid()) + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(tmp_filename, 'w') as f:
+            f.write(contents)
+        os.replace(tmp_filename, filename)
+    except OSError:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        return False
+    return True
+
+
+_input_files = {}
+
+
+# Returns [mtime, size] of filename, or None if it doesn't exist.
+# The result of an activation depends on the files checked here, so they're recorded in _input_files,
+# to know when something computed from them is outdated.
+def file_stamp(filename):
+    path = os.path.normcase(os.path.normpath(os.path.abspath(filename)))
+    listing = folder_listing(os.path.dirname(path))
+    try:
+        # Listings only have the config files, an include can be named anything
+        if listing is None or not path.endswith(LISTED_EXTENSIONS):
+            st = os.stat(filename)
+        else:
+            st = listing[os.path.basename(path)].stat()
+        stamp = [st.st_mtime_ns, st.st_size]
+    except (OSError, KeyError):
+        stamp = None
+
+    _input_files[filename] = stamp
+    return stamp
+
+
+# The use folder is usually on a network share, where every stat is a round trip. Instead of checking each
+# candidate file on its own, the use and targets folders are listed once with os.scandir(), and file_stamp()
+# answers from that. On Windows the listing already has the stat data, elsewhere it's only fetched for the files
+# that exist and are asked for.
+_folder_listings = {}
+LISTED_EXTENSIONS = ('.json', '.source', '.bat')
+
+
+# Returns the {name: DirEntry} of the config files in folder, or None if folder isn't one of the listed ones.
+# Names and folder are normcase'd, as Windows doesn't care about the case of file names.
+def folder_listing(folder):
+    if not _folder_listings:
+        for listed_folder in [use_conf().useFolder(), use_conf().targetsFolder()]:
+            _folder_listings[os.path.normcase(os.path.normpath(os.path.abspath(listed_folder)))] = None
+
+    if folder not in _folder_listings:
+        return None
+
+    if _folder_listings[folder] is None:
+        listing = {}
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    name = os.path.normcase(entry.name)
+                    if name.endswith(LISTED_EXTENSIONS):
+                        listing[name] = entry
+        except OSError:
+            pass
+        _folder_listings[folder] = listing
+
+    return _folder_listings[folder]
+
+
+def input_files_changed():
+    for filename, stamp in list(_input_files.items()):
+        if file_stamp(filename) != stamp:
+            return True
+    return False
+
+
+# Caches the decoded contents of targets.json and of every per-target json (and their includes)
+# in a single file. Entries are keyed by the file's mtime and size, so only files that changed
+# since the last invocation are parsed again.
+class ConfigCache:
+    VERSION = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.reparsed = set()
+        self.dirty = False
+        self.loaded = False
+
+    def load(self):
+        self.loaded = True
+        if not self.filename:
+            return
+
+        try:
+            with open(self.filename, 'r') as f:
+                decoded = json.loads(f.read())
+        except (OSError, ValueError):
+            return
+
+        if decoded.get('version') == ConfigCache.VERSION:
+            self.entries = decoded.get('files', {})
+
+    # Returns the decoded json for filename, None if it doesn't exist
+    def readJson(self, filename):
+        if not self.loaded:
+            self.load()
+
+        filename = os.path.abspath(filename)
+        stamp = file_stamp(filename)
+        if stamp is None:
+            return None
+
+        entry = self.entries.get(filename)
+        if entry is not None and entry['stamp'] == stamp:
+            return entry['decoded']
+
+        with open(filename, 'r') as f:
+            decoded = json.loads(f.read())
+
+        self.entries[filename] = {'stamp': stamp, 'decoded': decoded}
+        self.reparsed.add(filename)
+        self.dirty = True
+        return decoded
+
+    def save(self):
+        if not self.dirty or not self.filename:
+            return
+
+        contents = json.dumps({'version': ConfigCache.VERSION, 'files': self.entries}, separators=(',', ':'))
+        if write_file_atomically(self.filename, contents):
+            self.dirty = False
+
+
+def config_cache_filename():
+    folder = cache_folder()
+    if not folder:
+        return ""
+    return os.path.join(folder, 'config.cache')
+
+
+# Variables holding path lists, which get their duplicated entries removed.
+# Can be changed with "deduplicate_paths" at the top level of targets.json
+DEFAULT_PATH_LIST_VARIABLES = ['PATH', 'LD_LIBRARY_PATH', 'DYLD_LIBRARY_PATH', 'PKG_CONFIG_PATH',
+                               'CMAKE_PREFIX_PATH', 'QT_PLUGIN_PATH', 'QML2_IMPORT_PATH']
+
+# The env of the calling shell, --print only outputs what differs from it
+_initial_env = dict(os.environ)
+_use_conf = None
+_config_cache = ConfigCache(config_cache_filename())
 _rename_yakuake_tab = os.getenv('USE_YAKUAKE', '') == '1'
 _targets = {}
-_arguments = sys.argv[1:]
+_arguments = []
 _configure = False
 _switches = []
 _ask_for_ssh_keys = False
-_is_debug = '--debug' in sys.argv
+_source_mode = 'serial'
+_exec_shell = False
+_on_shell_exit = []  # commands to run when the shell exits, handed to the shell when it's exec'd
+_generic_targets_index = None
+_path_list_variables = DEFAULT_PATH_LIST_VARIABLES
+_is_debug = False
 _desired_command = ''
 _desired_cwd = ''
 _silent = False
 _ignore = ''
-_env_lines = []
-
-POSSIBLE_SWITCHES = ['--keep', '--config', '--configure', '--edit', '--conf', '--help',
-                     '-h', '--bash-autocomplete-helper', '--debug', '--silent', '--print', '--print-to-file']
+_env_is_cacheable = True
+_depends_on_cwd = False
+_input_variables = set()
+_sourced_scripts = []
+_env_changes = {}
+_env_undo = None  # with --push, the [target, {variable: previous value}] of each step sourced so far
+_env_undo_step = {}
 
 
 def list_separator(isForPrinting=False):
@@ -173,13 +601,50 @@ def list_separator(isForPrinting=False):
         return ';'
     return ':'
 
+
+_normalized_paths = {}
+
+
+# Builds a path list, normalizing each entry once and dropping empty entries.
+# For the variables in _path_list_variables duplicates are dropped too, the first occurrence wins
+# so the precedence of the entries is kept.
+class PathListBuilder:
+    def __init__(self, name, normalize):
+        self.deduplicate = name in _path_list_variables
+        self.normalize = normalize
+        self.paths = []
+        self.seen = set()
+
+    # value can itself be a list, for example ${PATH}
+    def add(self, value):
+        for path in value.split(list_separator()):
+            if not path:
+                continue
+
+            if self.normalize:
+                key = (self.normalize, path)
+                if key not in _normalized_paths:
+                    _normalized_paths[key] = self.normalize(path)
+                path = _normalized_paths[key]
+
+            if self.deduplicate:
+                key = path.rstrip('/\\') or path
+                if key in self.seen:
+                    continue
+                self.seen.add(key)
+
+            self.paths.append(path)
+
+    def value(self, separator):
+        return separator.join(self.paths)
+
 # Reads a property from json, but tries several platform suffixes
 
 
 def read_json_property(propName, json):
     # First try with OS qualification
     # for example, if propName is "cwd", we try "cwd_windows".
-    propNameCandiate = propName + "_" + platform.system().lower()
+    propNameCandiate = propName + "_" + platformNameLowercase()
 
     if propNameCandiate in json:
         return json[propNameCandiate]
@@ -201,9 +666,11 @@ class EnvVariable:
         self.name = ""
         self.value = ""
         self.values = []
+        self.template = None
+        self.templates = []
 
-    def isPath(self):
-        v = fill_placeholders(self.value)
+    # v is the value with its placeholders filled
+    def isPath(self, v):
         if v.startswith('-') or "=" in v:  # Hack, there's not an easy way to check if it's a path
             return False
 
@@ -223,35 +690,33 @@ class Target:
         self.arg = ""
         self.description = ""
         self.history = True
-
-        self.loadJson()
+        self.cache_env = True
+        self.shim_path = False
+        self.loaded = False
+        self.input_files = {}  # the stamps of the jsons loaded for it, includes too
+        self.include_cycle = False
+
+    # The json is only read when the target is actually needed, not when targets.json is parsed.
+    # Returns False if the target can't be activated, a missing include only leaves its variables out.
+    def load(self):
+        if not self.loaded:
+            self.loaded = True
+            self.loadJson()
+        return not self.include_cycle
 
     def jsonFileName(self):
-        return _use_conf.targetsFolder() + "/../" + self.name + ".json"
+        return use_conf().targetsFolder() + "/../" + self.name + ".json"
 
     def yakuakeTabName(self):
         if self.isGeneric():
             return self.yakuake_tab_name.replace("%", self.arg)
         return self.yakuake_tab_name
 
-    def env_var_from_json(self, json):
-        var = EnvVariable()
-        key = list(json.keys())[0]
-        var.name = key
-        value = json[key]
-        value_is_list = type(value) == type([])
-
-        if value_is_list:
-            var.values = value
-        else:
-            var.value = str(value)
-
-        return var
-
     def loadJson(self):
-        if not os.path.exists(self.jsonFileName()):
+        if file_stamp(self.jsonFileName()) is None:
             return False
-        return self.loadJsonFile(self.jsonFileName())
+        with profile_span('load ' + self.name, 'json', file=self.jsonFileName()):
+            return self.loadJsonFile(self.jsonFileName())
 
     def isGeneric(self):
         return "%" in self.name
@@ -266,21 +731,68 @@ class Target:
             return self.name.replace("-%", "")
         return self.name
 
-    def loadJsonFile(self, filename):
-        if not os.path.exists(filename):
-            print("File doesn't exist: " + filename)
+    def loadJsonFile(self, filename, including=None):
+        entry = load_json_file(filename)
+        if entry is None:
+            # stderr, as stdout might be eval'd
+            print("File doesn't exist: " + filename, file=sys.stderr)
             return False
 
-        f = open(filename, 'r')
-        # print("Processing " + filename
-        contents = f.read()
-        f.close()
-        decoded = json.loads(contents)
+        self.variables.extend(entry.variables)
+        self.input_files[entry.path] = _input_files[entry.path]
+
+        # Stack of the files being loaded, to catch files including each other
+        if including is None:
+            including = []
+        including.append(entry.path)
+
+        for include in entry.includes:
+            include = fill_placeholders(include)
+            if os.path.realpath(include) in including:
+                print("Include cycle: " + " -> ".join(including + [os.path.realpath(include)]), file=sys.stderr)
+                self.include_cycle = True
+                return False
+
+            with profile_span('include ' + include, 'include', target=self.name):
+                if not self.loadJsonFile(include, including):
+                    return False
+
+        including.pop()
+
+        if entry.description is not None:
+            self.description = entry.description
+
+        return True
+
+
+def env_var_from_json(json):
+    var = EnvVariable()
+    key = list(json.keys())[0]
+    var.name = key
+    value = json[key]
+    value_is_list = type(value) == type([])
+
+    if value_is_list:
+        var.values = value
+        var.templates = [compile_placeholders(token) for token in value]
+    else:
+        var.value = str(value)
+        var.template = compile_placeholders(var.value)
+
+    return var
+
+
+# What a target json (or a json it includes) contributes, once parsed.
+# Shared by all the targets using the file, so it's never modified.
+class JsonFile:
+    def __init__(self, path, decoded):
+        self.path = path
+        variables = []
 
         # first source 'nt' and 'posix'
         if osType() in decoded:
             for env_var in decoded[osType()]:
-                self.variables.append(self.env_var_from_json(env_var))
+                variables.append(env_var_from_json(env_var))
 
         # now source 'Linux', 'Darwin'or 'Windows', which have precedence
 
@@ -291,37 +803,58 @@ class Target:
 
         if plat in decoded:
             for env_var in decoded[plat]:
-                self.variables.append(self.env_var_from_json(env_var))
+                variables.append(env_var_from_json(env_var))
 
         if isWSL() and "Windows-WSL" in decoded:
             for env_var in decoded["Windows-WSL"]:
-                self.variables.append(self.env_var_from_json(env_var))
+                variables.append(env_var_from_json(env_var))
 
         # Source the platform-independent variables
         if "any" in decoded:
             for env_var in decoded["any"]:
-                self.variables.append(self.env_var_from_json(env_var))
+                variables.append(env_var_from_json(env_var))
 
-        if "includes" in decoded:
-            for include in decoded['includes']:
-                if not self.loadJsonFile(fill_placeholders(include)):
-                    return False
+        self.variables = tuple(variables)
+        self.includes = tuple(decoded.get('includes', []))
+        self.description = decoded.get('description')
 
-        if "description" in decoded:
-            self.description = decoded['description']
 
-        return True
+# Jsons included by many targets are only turned into variables once, keyed by their real path and stamp
+_json_files = {}
+
+
+def load_json_file(filename):
+    path = os.path.realpath(filename)
+    stamp = file_stamp(path)
+    if stamp is None:
+        return None
+
+    key = (path, stamp[0], stamp[1])
+    if key not in _json_files:
+        decoded = _config_cache.readJson(path)
+        if decoded is None:
+            return None
+        _json_files[key] = JsonFile(path, decoded)
+
+    return _json_files[key]
 
 
 def printUsage():
     print("Usage:")
     print(sys.argv[0] + " <target>")
-    print(sys.argv[0] + " <target> [--print|--print-to-file] [--command=<command>][--ignore=<target>]\n")
+    print(sys.argv[0] + " <target> [--print|--print-to-file|--plan|--snapshot] [--command=<command>][--ignore=<target>]"
+          "[--profile[=<file>]]")
+    print(sys.argv[0] + " <target> --push")
+    print(sys.argv[0] + " --pop")
+    print(sys.argv[0] + " --prompt")
+    print(sys.argv[0] + " <target> --switch")
+    print(sys.argv[0] + " --warm [target...]\n")
 
     print("Available targets:\n")
     for target in _targets:
         t = _targets[target]
         if not t.hidden:
+            t.load()
             str = "  " + target
             if t.description:
                 str += " (" + t.description + ")"
@@ -335,13 +868,18 @@ def cleanup_cwd(cwd):
 
 # Loads targets.json file into _targets variable
 def read_targets_json():
-    f = open(_use_conf.targetsJsonFilename(), 'r')
-    contents = f.read()
-    f.close()
+    decoded = _config_cache.readJson(use_conf().targetsJsonFilename())
+    if decoded is None:
+        print("File doesn't exist: " + use_conf().targetsJsonFilename())
+        return False
 
-    decoded = json.loads(contents)
+    global _ask_for_ssh_keys, _source_mode, _path_list_variables, _exec_shell
 
-    global _ask_for_ssh_keys
+    # The config might be loaded again, settings removed from it go back to their defaults
+    _ask_for_ssh_keys = False
+    _source_mode = 'serial'
+    _exec_shell = False
+    _path_list_variables = DEFAULT_PATH_LIST_VARIABLES
 
     if "targets" in decoded:
         for target in decoded['targets']:
@@ -376,33 +914,84 @@ def read_targets_json():
             if "hidden" in target:
                 t.hidden = target['hidden']
 
+            if "cache_env" in target:
+                t.cache_env = target['cache_env']
+
+            if "shim_path" in target:
+                t.shim_path = target['shim_path']
+
             _targets[t.name] = t
 
     if "ask_for_ssh_keys" in decoded:
         _ask_for_ssh_keys = decoded['ask_for_ssh_keys']
 
+    if "exec_shell" in decoded:
+        _exec_shell = decoded['exec_shell']
+
+    if "source_mode" in decoded:
+        _source_mode = decoded['source_mode']
+
+    if "deduplicate_paths" in decoded:
+        _path_list_variables = decoded['deduplicate_paths']
+
+    targets_json = os.path.abspath(use_conf().targetsJsonFilename())
+    # Completion only gets here when the index is missing or was written for another folder
+    if targets_json in _config_cache.reparsed or '--bash-autocomplete-helper' in _switches:
+        write_completion_index(targets_json)
+
+    build_generic_targets_index()
+
     return True
 
 
-def getGenericTargetAndArg(name):
-    candidates = []
-    for targetName in _targets.keys():
-        target = _targets[targetName]
+# Regenerates the index used by bash_autocomplete_from_index()
+def write_completion_index(targets_json):
+    if not completion_index_filename():
+        return
+
+    entry = _config_cache.entries[targets_json]
+    names = [name for name in _targets if not _targets[name].hidden]
+    stamp = str(entry['stamp'][0]) + " " + str(entry['stamp'][1])
+    write_file_atomically(completion_index_filename(),
+                          '\n'.join([use_folder_override(), targets_json, stamp, ' '.join(names)]) + '\n')
+
+
+# Builds a prefix trie of the generic targets, so getGenericTargetAndArg() doesn't need to scan all targets.
+# Each node maps a character to its child node, and None to the generic target's simpleName() ending there.
+def build_generic_targets_index():
+    global _generic_targets_index
+    _generic_targets_index = {}
+
+    for target in _targets.values():
         if target.isGeneric():
-            targetName = target.simpleName()  # Example "qt-" instead of "qt-%"
-            if name.startswith(targetName):
-                candidates.append(targetName)
+            node = _generic_targets_index
+            for c in target.simpleName():  # Example "qt" for "qt-%"
+                node = node.setdefault(c, {})
+            node[None] = target.simpleName()
 
-    # Sort candidates by length, so that "qt-mingw-%" matches "qt-mingw-", not "qt-"
-    if candidates:
-        candidates.sort(key=len, reverse=True)
-        arg = name.replace(candidates[0] + "-", "")
-        return {"name": candidates[0], "arg": arg}
+
+def getGenericTargetAndArg(name):
+    if _generic_targets_index is None:
+        build_generic_targets_index()
+
+    # Walk the trie and keep the longest match, so that "qt-mingw-%" matches "qt-mingw-", not "qt-"
+    node = _generic_targets_index
+    longest = node.get(None)
+    for c in name:
+        node = node.get(c)
+        if node is None:
+            break
+        longest = node.get(None, longest)
+
+    if longest is not None:
+        arg = name.replace(longest + "-", "")
+        return {"name": longest, "arg": arg}
 
     return {}
 
 
-def getTarget(name):
+# Returns None if there's no such target
+def findTarget(name):
     if name in _targets:
         return _targets[name]
 
@@ -411,35 +1000,79 @@ def getTarget(name):
     if genericTarget and genericTarget["name"] + "-%" in _targets:
         return _targets[genericTarget["name"] + "-%"]
 
-    print("Unknown target: " + name)
-    printUsage()
+    return None
+
+
+def getTarget(name):
+    target = findTarget(name)
+    if target is None:
+        print("Unknown target: " + name)
+        printUsage()
+    return target
 
 
 def set_env_variable(key, value):
+    if _env_undo is not None and key not in _env_undo_step:
+        # Recording only happens in print mode, so whatever wasn't changed yet still has the shell's value
+        _env_undo_step[key] = _env_changes.get(key, _initial_env.get(key))
+
     os.environ[key] = value
-    if _print_env_only:
-        line = ""
-        if ' ' in value or ';' in value:
-            line = f'export {key}="{value}"'
-        else:
-            line = f'export {key}={value}'
-        _env_lines.append(line)
+    # Last writer wins, and is moved to the end, so the output follows the order of the last assignments
+    _env_changes.pop(key, None)
+    _env_changes[key] = value
+
+
+# For undoing, value None means the variable didn't exist
+def restore_env_variable(key, value):
+    if value is not None:
+        set_env_variable(key, value)
+        return
+
+    if _env_undo is not None and key not in _env_undo_step:
+        _env_undo_step[key] = _env_changes.get(key, _initial_env.get(key))
+
+    os.environ.pop(key, None)
+    _env_changes.pop(key, None)
+    _env_changes[key] = None
+
+
+# Every invocation starts from env (the current one by default) plus USE_TARGETS_FOLDER, which scripts and jsons
+# can refer to. It's only set in our own env, export_targets_folder() makes it part of the printed changes.
+def prepare_invocation_env(env=None):
+    if env is not None:
+        os.environ.clear()
+        os.environ.update(env)
+    os.environ['USE_TARGETS_FOLDER'] = use_conf().useFolder()
+
+
+def export_targets_folder():
+    set_env_variable('USE_TARGETS_FOLDER', use_conf().useFolder())
+
+
+def export_line(key, value):
+    if ' ' in value or ';' in value:
+        return f'export {key}="{value}"'
+    return f'export {key}={value}'
 
 
 def source_single_json(target):
     global _print_env_only, _is_debug
 
+    if not target.load():
+        return False
+    # It might have been loaded for an earlier invocation
+    _input_files.update(target.input_files)
     for v in target.variables:
         if not v.name:
             continue
 
         if v.value:
+            value = v.template.expand()
+            is_path = v.isPath(value)
             if v.value == "USE_ARG":
                 value = target.arg
-            else:
-                value = fill_placeholders(v.value)
 
-            if v.isPath():
+            if is_path:
                 if _print_env_only:
                     value = to_unix_path(value)
                 else:
@@ -448,114 +1081,438 @@ def source_single_json(target):
             set_env_variable(v.name, value)
 
             if _is_debug:
-                print("var : " + v.name + "=" + value + " (v.isPath=" + str(v.isPath()) + ")")
+                print("var : " + v.name + "=" + value + " (v.isPath=" + str(is_path) + ")")
         else:  # list case
-            value = list_separator()
-            for list_token in v.values:
-                list_token = fill_placeholders(list_token)
-                if v.isPath():
-                    if _print_env_only:
-                        list_token = to_unix_path(list_token)
-                    else:
-                        list_token = to_native_path(list_token)
+            normalize = None
+            if v.isPath(v.value):
+                if _print_env_only:
+                    normalize = to_unix_path
+                else:
+                    normalize = to_native_path
 
-                value = value + list_separator(_print_env_only) + list_token
+            builder = PathListBuilder(v.name, normalize)
+            for template in v.templates:
+                builder.add(template.expand())
 
-            set_env_variable(v.name, value.strip(';').strip('.'))
+            set_env_variable(v.name, builder.value(list_separator(_print_env_only)))
+
+    return True
 
 # Sources oldschool .source file, not .json
-def source_single_file(filename):
+def source_single_file(filename, cacheable=True):
     global _silent
-    command = ""
 
-    filename_cmd = filename
+    if not _silent:
+        print("Sourcing " + to_native_path(filename))
 
     shell = shellForOS(filename)
-    if shell == 'cmd':
-        command = ['cmd', '/C', filename_cmd + ' && set']
-        # os.environ['PROMPT'] = ""
-    else:
-        command = [shell, '-c', 'source ' + filename_cmd + ' && env']
+    cache_filename = env_delta_cache_filename(filename, shell, cacheable)
+    if source_cached_delta(cache_filename):
+        return True
 
-    proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+    delta = run_source_script(filename, shell)
+    if delta is None:
+        # A failed script doesn't change anything, and isn't cached, so it's run again next time
+        return True
 
-    if not _silent:
-        print("Sourcing " + to_native_path(filename_cmd))
+    apply_env_delta(delta)
 
-    # for line in io.TextIOWrapper(proc.stdout, encoding="utf-8"):
-    for line in proc.stdout:
-        foo = line.decode('utf-8').partition("=")
-        (key, _, value) = foo
-        if key and not key.startswith('BASH_FUNC_'):
-            try:
-                set_env_variable(key, value.strip())
-            except:
-                print("Error importing key=" + key + "; with value=" + value.strip())
-                raise
-    proc.communicate()
+    if cache_filename:
+        write_file_atomically(cache_filename, json.dumps(delta))
 
     return True
 
 
-def extensionForScript():
-    if isWindows():
-        return ".bat"
-    return ".source"
+# .source scripts are usually deterministic, so what they changed in the env is cached, keyed by the script
+# and by the values of the variables it reads. Targets with side effects can opt out with "cache_env": false
+def env_delta_cache_filename(filename, shell, cacheable):
+    if not cacheable or not cache_folder():
+        return ""
+    return os.path.join(cache_folder(), 'env', env_delta_cache_key(filename, shell) + '.json')
 
 
-def filenameForTarget(target):
-    filename = _use_conf.targetsFolder() + "/" + target.name + extensionForScript()
-    if os.path.exists(target.jsonFileName()) or target.isGeneric():
-        if os.path.exists(filename):
-            print("Favoring .json over " + filename)
+# Applies the cached env changes of a script, returns False if there's nothing cached for it
+def source_cached_delta(cache_filename):
+    if not cache_filename:
+        return False
 
-        return target.jsonFileName()
+    delta = read_env_delta(cache_filename)
+    if delta is None:
+        return False
 
-    return filename
+    apply_env_delta(delta)
+    return True
 
 
-def currentTargets():
-    targets = os.getenv('USE_CURRENT_TARGETS')
-    if not targets:
-        return []
-    return targets.split(';')
+# Sources consecutive .source scripts in a single shell instead of one shell per script.
+# batch holds (target, filename) steps, filename is None for steps that aren't scripts, for example a
+# .source target without any file, which only need their bookkeeping done in order.
+def source_batch(batch):
+    if _source_mode == 'parallel':
+        source_parallel(batch)
+        return
+
+    scripts = [(target, filename) for (target, filename) in batch if filename]
+    if not scripts:
+        for (target, _) in batch:
+            mark_target_sourced(target)
+        return
+
+    shell = shellForOS(scripts[0][1])
+    envs = run_source_scripts_batched([filename for (_, filename) in scripts], shell)
+
+    previous_env = dict(os.environ)
+    for (target, filename) in batch:
+        if filename:
+            if not envs:
+                # A script failed, which stops the chain, source whatever is left one by one
+                source_single_file(filename, target.cache_env)
+                mark_target_sourced(target)
+                continue
+
+            env = envs.pop(0)
+            delta = script_env_delta(filename, shell, previous_env, env)
+            previous_env = env
+
+            cache_filename = env_delta_cache_filename(filename, shell, target.cache_env)
+            if cache_filename:
+                write_file_atomically(cache_filename, json.dumps(delta))
+            apply_env_delta(delta)
+
+        mark_target_sourced(target)
+
+
+BATCH_STEP_DELIMITER = '--- use: end of step ---'
+
+
+# In parallel mode, consecutive scripts which don't depend on each other all run at the same time, from the same env.
+# Their changes are then applied in the order of the plan.
+def source_parallel(batch):
+    group = []
+    for (target, filename) in batch:
+        if group and depends_on_any(target, group):
+            source_independent_scripts(group)
+            group = []
+        group.append((target, filename))
+
+    source_independent_scripts(group)
+
+
+def depends_on_any(target, steps):
+    uses = [resolveTargetName(name)[0] for name in target.uses]
+    for (t, _) in steps:
+        if t in uses or target in [resolveTargetName(name)[0] for name in t.uses_after]:
+            return True
+    return False
+
+
+def source_independent_scripts(steps):
+    scripts = [filename for (_, filename) in steps if filename]
+    if not scripts:
+        for (target, _) in steps:
+            mark_target_sourced(target)
+        return
+
+    base_env = dict(os.environ)
+    envs = run_source_scripts_parallel(scripts)
+
+    for (target, filename) in steps:
+        env = envs.pop(0) if filename else None
+        if env is not None:
+            shell = shellForOS(filename)
+            inputs = script_input_variables(read_script(filename), shell)
+
+            # What the script read might have been changed by the steps applied before it
+            changed = [key for key in inputs if os.environ.get(key) != base_env.get(key)]
+            delta = rebase_env_delta(script_env_delta(filename, shell, base_env, env), base_env, changed)
+            if delta is None:
+                # It saw stale values, so it has to run again
+                source_single_file(filename, target.cache_env)
+            else:
+                cache_filename = env_delta_cache_filename(filename, shell, target.cache_env)
+                if cache_filename and not changed:
+                    write_file_atomically(cache_filename, json.dumps(delta))
+                apply_env_delta(delta)
 
+        mark_target_sourced(target)
 
-def currentTargetsStr():
-    return ' '.join(currentTargets())
 
+# Returns the env after each script, None for the ones which failed
+def run_source_scripts_parallel(filenames):
+    import subprocess
+    procs = []
+    with profile_span('spawn', 'script', scripts=filenames):
+        for filename in filenames:
+            procs.append(subprocess.Popen(source_script_command(filename, shellForOS(filename)), stdout=subprocess.PIPE))
 
-def shellForOS(filename=""):
-    # .bat files are always sourced by cmd. Use .json if you don't like this
-    if filename.endswith(".bat") or filename.endswith(".cmd"):
-        return 'cmd'
+    outputs = []
+    with profile_span('wait', 'script', scripts=filenames):
+        for proc in procs:
+            outputs.append(proc.communicate()[0])
 
-    envShell = os.getenv('SHELL')
-    if _is_debug:
-        print("shell=" + envShell)
+    with profile_span('parse', 'script', scripts=filenames):
+        return [parse_env_output(output.splitlines()) if proc.returncode == 0 else None
+                for (proc, output) in zip(procs, outputs)]
 
-    # Workaround Git Bash bug on Windows, where it prepends the current cwd:
-    if envShell is not None:
-        if envShell.endswith('/bash') or envShell.endswith('\\bash'):
-            envShell = 'bash'
 
-    if envShell and envShell != '/bin/false':
-        return envShell
+# A script computed delta from base_env, but the variables in changed have other values now. If all it did with them
+# was prepending or appending to a path list, the same is done to their current value.
+# Returns None if it did anything else with them.
+def rebase_env_delta(delta, base_env, changed):
+    rebased = dict(delta)
+    separator = list_separator()
 
-    if isWindows():
-        return 'cmd'
+    for key in changed:
+        base = base_env.get(key, '')
+        value = delta.get(key)
+        if key not in _path_list_variables or value is None or not base or value.count(base) != 1:
+            return None
 
-    return 'bash'
+        (prefix, suffix) = value.split(base)
+        if (prefix and not prefix.endswith(separator)) or (suffix and not suffix.startswith(separator)):
+            return None
 
+        rebased[key] = prefix + os.environ.get(key, '') + suffix
 
-def run_command(cmd):
-    return os.system(cmd) == 0
+    return rebased
 
 
-def run_shell(cwd):
-    global _is_debug
-    if _is_debug:
-        print("run_shell: cwd=" + cwd)
+# Returns the env after each script, for as many scripts as succeeded
+def run_source_scripts_batched(filenames, shell):
+    steps = []
+    for filename in filenames:
+        if shell == 'cmd':
+            steps.append(filename + ' && set && echo ' + BATCH_STEP_DELIMITER)
+        else:
+            steps.append('source ' + filename + ' && env && echo ' + BATCH_STEP_DELIMITER)
+
+    if shell == 'cmd':
+        command = ['cmd', '/C', ' && '.join(steps)]
+    else:
+        command = [shell, '-c', ' && '.join(steps)]
+
+    import subprocess
+    with profile_span('spawn', 'script', scripts=filenames):
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+    with profile_span('wait', 'script', scripts=filenames):
+        (output, _) = proc.communicate()
+
+    envs = []
+    lines = []
+    with profile_span('parse', 'script', scripts=filenames):
+        for line in output.splitlines():
+            if line.decode('utf-8').strip() == BATCH_STEP_DELIMITER:
+                envs.append(parse_env_output(lines))
+                lines = []
+            else:
+                lines.append(line)
+
+    return envs
+
+
+def source_script_command(filename, shell):
+    if shell == 'cmd':
+        # os.environ['PROMPT'] = ""
+        return ['cmd', '/C', filename + ' && set']
+    return [shell, '-c', 'source ' + filename + ' && env']
+
+
+# Runs the script in a shell and returns the variables it changed, in the order the shell printed them.
+# Returns None if the script failed.
+def run_source_script(filename, shell):
+    import subprocess
+    with profile_span('spawn', 'script', script=filename):
+        proc = subprocess.Popen(source_script_command(filename, shell), stdout=subprocess.PIPE)
+    with profile_span('wait', 'script', script=filename):
+        (output, _) = proc.communicate()
+    if proc.returncode != 0:
+        return None
+    with profile_span('parse', 'script', script=filename):
+        env = parse_env_output(output.splitlines())
+        return script_env_delta(filename, shell, os.environ, env)
+
+
+def parse_env_output(lines):
+    env = {}
+    for line in lines:
+        (key, _, value) = line.decode('utf-8').partition("=")
+        if key and not key.startswith('BASH_FUNC_'):
+            env[key] = value.strip()
+    return env
+
+
+# Variables the shell maintains itself, they're not something a script changed
+SHELL_BOOKKEEPING_VARIABLES = ['SHLVL', '_', 'PWD', 'OLDPWD']
+
+
+def env_delta(old_env, new_env):
+    delta = {}
+    for key, value in new_env.items():
+        if key not in SHELL_BOOKKEEPING_VARIABLES and old_env.get(key) != value:
+            delta[key] = value
+    return delta
+
+
+# The delta of a script also has the variables it assigns to the value they already had, otherwise a cached
+# delta would miss them when the script runs from an env where they have another value
+def script_env_delta(filename, shell, old_env, new_env):
+    assigned = script_assigned_variables(read_script(filename), shell)
+
+    delta = {}
+    for key, value in new_env.items():
+        if key not in SHELL_BOOKKEEPING_VARIABLES and (key in assigned or old_env.get(key) != value):
+            delta[key] = value
+    return delta
+
+
+def apply_env_delta(delta):
+    for key, value in delta.items():
+        if key in _path_list_variables:
+            builder = PathListBuilder(key, os.path.normpath)
+            builder.add(value)
+            value = builder.value(list_separator())
+
+        try:
+            set_env_variable(key, value)
+        except:
+            print("Error importing key=" + key + "; with value=" + value)
+            raise
+
+
+# Names of the env variables a script reads, for example PATH in "export PATH=/foo:$PATH"
+def script_input_variables(contents, shell):
+    if shell == 'cmd':
+        return set(re.findall('%([A-Za-z_][A-Za-z0-9_]*)%', contents))
+    return set(re.findall('\\$\\{?([A-Za-z_][A-Za-z0-9_]*)', contents))
+
+
+# Names of the env variables a script assigns, for example CC in "export CC=gcc"
+def script_assigned_variables(contents, shell):
+    if shell == 'cmd':
+        return set(re.findall('(?im)^\\s*set\\s+"?([A-Za-z_][A-Za-z0-9_]*)=', contents))
+    return set(re.findall('(?:^|[\\s;&|(])([A-Za-z_][A-Za-z0-9_]*)=', contents))
+
+
+# Changes whenever what's stored in the cached deltas changes
+ENV_DELTA_VERSION = 2
+
+
+# Scripts can be in any encoding, only the variable names in them matter
+def read_script(filename):
+    with open(filename, 'rb') as f:
+        return f.read().decode('utf-8', 'replace')
+
+
+def env_delta_cache_key(filename, shell):
+    import hashlib
+    with open(filename, 'rb') as f:
+        contents = f.read()
+
+    h = hashlib.sha256(contents)
+    h.update(shell.encode('utf-8'))
+    h.update(str(ENV_DELTA_VERSION).encode('utf-8'))
+    for name in sorted(script_input_variables(contents.decode('utf-8', 'replace'), shell)):
+        value = os.environ.get(name)
+        h.update(b'\0' + name.encode('utf-8'))
+        if value is not None:
+            h.update(b'=' + value.encode('utf-8', 'surrogateescape'))
+
+    return h.hexdigest()
+
+
+def read_env_delta(cache_filename):
+    try:
+        with open(cache_filename, 'r') as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def extensionForScript():
+    if isWindows():
+        return ".bat"
+    return ".source"
+
+
+def filenameForTarget(target):
+    filename = use_conf().targetsFolder() + "/" + target.name + extensionForScript()
+    if file_stamp(target.jsonFileName()) is not None or target.isGeneric():
+        if file_stamp(filename) is not None:
+            print("Favoring .json over " + filename)
+
+        return target.jsonFileName()
+
+    return filename
+
+
+def shellForOS(filename=""):
+    # .bat files are always sourced by cmd. Use .json if you don't like this
+    if filename.endswith(".bat") or filename.endswith(".cmd"):
+        return 'cmd'
+
+    envShell = os.getenv('SHELL')
+    if _is_debug:
+        print("shell=" + envShell)
+
+    # Workaround Git Bash bug on Windows, where it prepends the current cwd:
+    if envShell is not None:
+        if envShell.endswith('/bash') or envShell.endswith('\\bash'):
+            envShell = 'bash'
+
+    if envShell and envShell != '/bin/false':
+        return envShell
+
+    if isWindows():
+        return 'cmd'
+
+    return 'bash'
+
+
+def run_command(cmd, is_shell=False):
+    sys.stdout.flush()  # or buffered output shows up after the command's
+    profile_instant('shell launch', 'shell', command=cmd)
+    write_profile()
+
+    if _exec_shell and not isWindows():
+        exec_command(cmd, is_shell)
+
+    return os.system(cmd) == 0
+
+
+# Replaces this process with the shell or command, instead of keeping python and a /bin/sh around for as
+# long as the shell is open. What would run once it exits is passed in USE_ON_EXIT, for the shell's EXIT trap.
+# Installs the EXIT trap, the same as the README suggests for the rc file. USE_ON_EXIT is taken out of the env,
+# so shells started from this one don't run it when they exit.
+ON_EXIT_TRAP = 'use_on_exit="$USE_ON_EXIT"; unset USE_ON_EXIT; trap \'eval "$use_on_exit"\' EXIT\n'
+
+
+def exec_command(cmd, is_shell):
+    _config_cache.save()  # atexit handlers don't run on exec
+
+    on_exit = '; '.join(_on_shell_exit)
+    if on_exit:
+        os.environ['USE_ON_EXIT'] = on_exit
+    else:
+        os.environ.pop('USE_ON_EXIT', None)  # the one from an outer use doesn't apply here
+
+    if is_shell:
+        args = [cmd]
+    elif on_exit:
+        args = ['/bin/sh', '-c', ON_EXIT_TRAP + cmd]
+    else:
+        args = ['/bin/sh', '-c', cmd]
+
+    sys.stderr.flush()
+    try:
+        os.execvp(args[0], args)
+    except OSError:
+        pass  # the caller falls back to os.system(), which reports the error
+
+
+def run_shell(cwd):
+    global _is_debug
+    if _is_debug:
+        print("run_shell: cwd=" + cwd)
 
     cmd = ""
     shell = shellForOS()
@@ -581,7 +1538,7 @@ def run_shell(cwd):
         if _is_debug:
             print('Running ' + cmd)
 
-        result = run_command(cmd)
+        result = run_command(cmd, True)
     except:
         pass
 
@@ -611,55 +1568,430 @@ def envFile():
 def print_target(target):
     global _print_env_to_file, _silent
 
+    export_targets_folder()
+
     # simpler to just reuse source_target, as it has some business logic
-    source_target(target)
+    if not source_target(target):
+        return False
+
+    if _env_undo is not None:
+        push_env_frame()
+
+    print_env_changes(cleanup_cwd(target.cwd))
+    return True
+
+
+def print_env_changes(cwd):
+    env_lines = []
+    for key, value in _env_changes.items():
+        if _initial_env.get(key) != value:
+            if value is None:
+                env_lines.append('unset ' + key)
+            else:
+                env_lines.append(export_line(key, value))
 
-    cwd = cleanup_cwd(target.cwd)
     if cwd:
-        _env_lines.append(f'export PWD="{cwd}"')
+        env_lines.append(f'export PWD="{cwd}"')
+
+    write_env_lines(env_lines)
+
 
+def write_env_lines(env_lines):
+    global _env_file_lines
     # --print prints to stdout, while --print-to-file prints to file
     if _print_env_to_file:
-        with open(envFile(), "w") as f:
-            for line in _env_lines:
-                f.write(line + "\n")
+        if _is_daemon:
+            # Responses are memoized, so the client writes the file
+            _env_file_lines = env_lines
+        else:
+            write_env_file(env_lines)
     else:
-        for line in _env_lines:
+        for line in env_lines:
             print(line)
 
 
-def source_target(target):
-    global _silent
-    if target.name in currentTargets():
+def write_env_file(env_lines):
+    with open(envFile(), "w") as f:
+        for line in env_lines:
+            f.write(line + "\n")
+
+
+# --push and --pop keep a stack of frames in USE_ENV_STACK, separated by ':'. Each frame is what one --push changed,
+# as the list of its steps with the previous values of the variables they set, compressed and base64 encoded.
+ENV_STACK_VARIABLE = 'USE_ENV_STACK'
+
+
+def env_stack():
+    return [frame for frame in os.getenv(ENV_STACK_VARIABLE, '').split(':') if frame]
+
+
+def encode_env_frame(steps):
+    import base64
+    import zlib
+    return base64.urlsafe_b64encode(zlib.compress(json.dumps(steps).encode('utf-8'))).decode('ascii')
+
+
+def decode_env_frame(frame):
+    import base64
+    import zlib
+    return json.loads(zlib.decompress(base64.urlsafe_b64decode(frame)).decode('utf-8'))
+
+
+def start_env_undo():
+    global _env_undo
+    _env_undo = []
+    _env_undo_step.clear()
+
+
+# Adds the steps recorded since start_env_undo() to the stack
+def push_env_frame():
+    global _env_undo
+    frames = env_stack() + [encode_env_frame(_env_undo)]
+    _env_undo = None
+    set_env_variable(ENV_STACK_VARIABLE, ':'.join(frames))
+
+
+# Prints what restores the env to before the last --push
+def pop_env():
+    frames = env_stack()
+    if not frames:
+        print("Nothing to pop, use --push first", file=sys.stderr)
+        return 1
+
+    try:
+        steps = decode_env_frame(frames.pop())
+    except ValueError:
+        print("Invalid " + ENV_STACK_VARIABLE, file=sys.stderr)
+        return 1
+
+    # The first step that changed a variable knows its value from before the push
+    previous_values = {}
+    for (_, undo) in reversed(steps):
+        previous_values.update(undo)
+
+    if frames:
+        previous_values[ENV_STACK_VARIABLE] = ':'.join(frames)
+    else:
+        previous_values[ENV_STACK_VARIABLE] = None
+
+    for (key, value) in previous_values.items():
+        restore_env_variable(key, value)
+
+    print_env_changes("")
+    return 0
+
+
+# Switches from the current targets to target, undoing only the steps that aren't part of target's plan, and sourcing
+# only what's new. Only works if what's active was --push'ed (or --switch'ed), as that's when the previous values of
+# each step are known. Otherwise it falls back to resetting the env.
+def switch_target(target):
+    global _env_undo
+    try:
+        frames = [decode_env_frame(frame) for frame in env_stack()]
+    except ValueError:
+        frames = []
+
+    steps = [step for frame in frames for step in frame]
+    names = [name for (name, _) in steps]
+    current = currentTargets()
+    if not steps or current[len(current) - len(names):] != names:
+        return switch_target_with_reset(target)
+
+    # Plan from what was there before the first push
+    plan = plan_target(target, [], set(current[:len(current) - len(names)]))
+    if plan is None:
+        return False
+
+    common = 0
+    for (t, arg) in plan:
+        t.arg = arg
+        if common == len(names) or names[common] != t.displayName():
+            break
+        common += 1
+
+    # The earliest undone step knows the values from before the diverging steps
+    previous_values = {}
+    for (_, undo) in reversed(steps[common:]):
+        previous_values.update(undo)
+    for (key, value) in previous_values.items():
+        restore_env_variable(key, value)
+
+    # Frames only keep the common steps
+    kept_frames = []
+    remaining = common
+    for frame in frames:
+        if remaining == 0:
+            break
+        kept_frames.append(frame[:remaining])
+        remaining -= min(remaining, len(frame))
+
+    if common < len(plan):
+        start_env_undo()
+        # Recorded by the first new step, like --push does, so --pop unsets it
+        export_targets_folder()
+        source_plan(plan[common:])
+        # The new steps go into the last kept frame, so --pop still undoes a whole --push
+        if kept_frames:
+            kept_frames[-1] = kept_frames[-1] + _env_undo
+        else:
+            kept_frames.append(_env_undo)
+        _env_undo = None
+
+    encoded = [encode_env_frame(frame) for frame in kept_frames]
+    restore_env_variable(ENV_STACK_VARIABLE, ':'.join(encoded) if encoded else None)
+
+    print_env_changes(cleanup_cwd(target.cwd))
+    return True
+
+
+def switch_target_with_reset(target):
+    restore_env_variable(ENV_STACK_VARIABLE, None)
+    if not reset_env():
+        return False
+
+    start_env_undo()
+    return print_target(target)
+
+
+# Resolves the dependency graph of target into the ordered list of (target, arg) steps to source, without
+# sourcing anything yet. Dependencies are sourced before the targets using them, and the ones shared by
+# several targets only once. Targets which are already sourced are skipped.
+# Returns None if the graph has a cycle.
+def plan_target(target, plan=None, planned=None):
+    if plan is None:
+        plan = []
+        planned = set(currentTargets())
+
+    if not visit_target(target, target.arg, plan, planned, []):
+        return None
+
+    return plan
+
+
+# Depth-first visit for plan_target(). path holds the targets being visited, to detect cycles
+def visit_target(target, arg, plan, planned, path):
+    target.arg = arg
+    name = target.displayName()
+    if target.name in planned or name in planned:
         return True
 
+    if name in path:
+        print("Dependency cycle: " + " -> ".join(path[path.index(name):] + [name]))
+        return False
+
+    path.append(name)
     for targetName in target.uses:
         if targetName == _ignore:
             # user passed --ignore=foo
             continue
 
-        targetToUse = getTarget(targetName)
-        generic = getGenericTargetAndArg(targetName)
+        (targetToUse, usesArg) = resolveTargetName(targetName)
+        if usesArg is None:
+            usesArg = targetToUse.arg
+
+        if not visit_target(targetToUse, usesArg, plan, planned, path):
+            return False
+    path.pop()
+
+    target.arg = arg
+    plan.append((target, arg))
+    planned.add(name)
+
+    # uses_after targets depend on us, so we're not part of the path anymore
+    for targetName in target.uses_after:
+        targetToUse = resolveTargetName(targetName)[0]
+        if not visit_target(targetToUse, targetToUse.arg, plan, planned, path):
+            return False
+
+    return True
+
+
+_resolved_target_names = {}
+
+
+# Returns the target for a name in "uses", and the argument the name passes to it, if it's generic
+def resolveTargetName(name):
+    if name not in _resolved_target_names:
+        target = getTarget(name)
+        arg = None
+        generic = getGenericTargetAndArg(name)
         if generic and generic['arg'] != '%':
             # Argument is already set, so use it. For example
             # 'qt-installer-mingw-%' uses 'mingw64-730', so use 730 for mingw64, instead of the top-level argument passed (5.14.2 for example)
-            targetToUse.arg = generic['arg']
+            arg = generic['arg']
+        _resolved_target_names[name] = (target, arg)
 
-        if not source_target(targetToUse):
-            return False
+    return _resolved_target_names[name]
+
+
+def source_target(target):
+    with profile_span('resolve dependencies', 'resolve', target=target.name):
+        plan = plan_target(target)
+    if plan is None:
+        return False
+    return source_plan(plan)
+
+
+# Returns the plan for target, including default if reset, or None if the graph has a cycle
+def activation_plan(target, reset):
+    planned = set(currentTargets())
+    plan = []
+    if reset:
+        planned = set()
+        plan = plan_target(getTarget("default"), plan, planned)
+
+    if plan is None or plan_target(target, plan, planned) is None:
+        return None
 
+    return plan
+
+
+# Returns the file sourced for the target of a plan step, or "" if it has none
+def plan_step_filename(target, arg):
+    target.arg = arg
     filename = filenameForTarget(target)
+    if filename.endswith(".json") or file_stamp(filename) is not None:
+        return filename
+    return ""
 
-    if filename.endswith(".json"):
-        arg = ""
-        if target.arg:
-            arg = " " + target.arg
-        if not _silent:
-            print("Sourcing " + to_native_path(filename) + arg)
-        source_single_json(target)
-    else:
-        if os.path.exists(filename):
-            source_single_file(filename)
+
+def print_plan(target, reset):
+    plan = activation_plan(target, reset)
+    if plan is None:
+        return False
+
+    for (t, arg) in plan:
+        filename = plan_step_filename(t, arg)
+        if filename:
+            print(t.displayName() + " (" + to_native_path(filename) + ")")
+        else:
+            print(t.displayName())
+
+    return True
+
+
+def source_plan(plan):
+    global _silent, _env_is_cacheable
+    batch = []
+
+    for (target, arg) in plan:
+        with profile_span('target ' + target.displayName(), 'target', target=target.displayName()):
+            target.arg = arg
+            filename = filenameForTarget(target)
+            if not target.cache_env:
+                _env_is_cacheable = False
+
+            if filename.endswith(".json"):
+                source_batch(batch)
+                batch = []
+
+                arg = ""
+                if target.arg:
+                    arg = " " + target.arg
+                if not _silent:
+                    print("Sourcing " + to_native_path(filename) + arg)
+                with profile_span('source ' + os.path.basename(filename), 'source', target=target.displayName()):
+                    if not source_single_json(target):
+                        return False
+            elif file_stamp(filename) is not None:
+                _sourced_scripts.append(filename)
+                if _source_mode in ['batch', 'parallel']:
+                    cache_filename = env_delta_cache_filename(filename, shellForOS(filename), target.cache_env)
+                    if batch or not source_cached_delta(cache_filename):
+                        if not _silent:
+                            print("Sourcing " + to_native_path(filename))
+                        # Bookkeeping happens once the batch ran
+                        batch.append((target, filename))
+                        continue
+                else:
+                    source_single_file(filename, target.cache_env)
+
+            if batch:
+                batch.append((target, None))
+            else:
+                mark_target_sourced(target)
+
+    source_batch(batch)
+    return True
+
+
+def shim_folder():
+    folder = cache_folder()
+    if not folder:
+        return ""
+    return os.path.join(folder, 'shims')
+
+
+# For targets with "shim_path": true. Puts a folder in front of PATH with a symlink for every executable name in PATH,
+# pointing to the executable the name resolves to, so commands are found with one lookup however long PATH is.
+# The folder is named after PATH and the mtimes of its folders, so it's only rebuilt when one of those changes.
+def use_shim_path(target):
+    import hashlib
+    root = shim_folder()
+    if not root or isWindows():
+        return
+
+    paths = []
+    for path in os.getenv('PATH', '').split(os.pathsep):
+        # What comes after a relative entry depends on the cwd, so it isn't shimmed
+        if not os.path.isabs(path):
+            break
+        # The shim folder of a previous activation is replaced, not stacked
+        if os.path.dirname(os.path.normpath(path)) != root:
+            paths.append(path)
+
+    with profile_span('shim PATH', 'shim', target=target.displayName()):
+        # The stamps also make snapshots and the daemon notice when an executable is added or removed
+        stamps = [file_stamp(path) for path in paths]
+        path_key = hashlib.sha256(os.pathsep.join(paths).encode('utf-8')).hexdigest()[:16]
+        stamps_key = hashlib.sha256(json.dumps(stamps).encode('utf-8')).hexdigest()[:16]
+        folder = os.path.join(root, path_key + '-' + stamps_key)
+        if file_stamp(folder) is None and not build_shim_folder(folder, paths):
+            print("Error creating " + folder)
+            return
+
+    others = [path for path in os.getenv('PATH', '').split(os.pathsep) if os.path.dirname(os.path.normpath(path)) != root]
+    set_env_variable('PATH', os.pathsep.join([folder] + others))
+
+
+def build_shim_folder(folder, paths):
+    import shutil
+    tmp_folder = folder + '.tmp' + str(os.getpid())
+    try:
+        os.makedirs(tmp_folder)
+        names = set()
+        for path in paths:
+            try:
+                with os.scandir(path) as entries:
+                    entries = list(entries)
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.name in names or not entry.is_file() or not os.access(entry.path, os.X_OK):
+                        continue
+                except OSError:
+                    continue
+                names.add(entry.name)
+                os.symlink(entry.path, os.path.join(tmp_folder, entry.name))
+        os.rename(tmp_folder, folder)
+    except OSError:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        # Another use might have built the same folder meanwhile
+        return os.path.isdir(folder)
+
+    # Older versions for the same PATH are outdated now
+    prefix = os.path.basename(folder).split('-')[0] + '-'
+    for name in os.listdir(os.path.dirname(folder)):
+        if name.startswith(prefix) and name != os.path.basename(folder) and '.tmp' not in name:
+            shutil.rmtree(os.path.join(os.path.dirname(folder), name), ignore_errors=True)
+
+    return True
+
+
+def mark_target_sourced(target):
+    if target.shim_path:
+        use_shim_path(target)
 
     newCurTargets = ';'.join(currentTargets())
 
@@ -670,11 +2002,10 @@ def source_target(target):
     if hist_folder and target.history and not target.hidden:
         set_env_variable('HISTFILE', hist_folder + '/' + target.name + '.hist')
 
-    for targetName in target.uses_after:
-        if not source_target(getTarget(targetName)):
-            return False
-
-    return True
+    if _env_undo is not None:
+        undo = {key: value for (key, value) in _env_undo_step.items() if _env_changes.get(key) != value}
+        _env_undo.append([target.displayName(), undo])
+        _env_undo_step.clear()
 
 
 def reset_env():
@@ -682,37 +2013,56 @@ def reset_env():
     return source_target(getTarget("default"))
 
 
+def rename_yakuake_tab(name):
+    if name and _rename_yakuake_tab:
+        os.system("rename_yatab.sh " + name)
+        _on_shell_exit.append("rename_yatab.sh Shell")
+        return True
+    return False
+
+
+# Calls activate(), which applies the env and runs the shell or command, with the yakuake tab renamed to name.
+# Returns what activate() returned.
+def with_yakuake_tab(name, activate):
+    # run qdbus before applying the env, otherwise it might use an incompatible Qt
+    with profile_span('rename yakuake tab', 'shell'):
+        must_restore_yakuake = rename_yakuake_tab(name)
+
+    try:
+        return activate()
+    finally:
+        if must_restore_yakuake:
+            os.system("rename_yatab.sh Shell")
+
+
 # Sources target recursively and opens a shell
 def run_shell_for_target(target):
-    global _switches, _rename_yakuake_tab, _desired_command, _desired_cwd
+    # The shell might stay open for hours, don't hold back the cache until then
+    _config_cache.save()
 
-    # run qdbus before sourcing, otherwise it might use an incompatible Qt
-    must_restore_yakuake = False
-    if target.yakuake_tab_name and _rename_yakuake_tab:
-        os.system("rename_yatab.sh " + target.yakuakeTabName())
-        must_restore_yakuake = True
-
-    success = False
-    if source_target(target):
+    def activate():
+        if not source_target(target):
+            return False
         if _is_debug:
             print("cwd=" + target.cwd)
             print("cleanup_cwd(target.cwd)=" + cleanup_cwd(target.cwd))
-        if _desired_command:
-            if _desired_cwd:
-                os.chdir(_desired_cwd)
-            # When --command=foo is passed, we run foo with the desired env, instead of opening an hanging shell
-            if _is_debug:
-                print("Desired Command=" + _desired_command + " ; _desired_cwd=" + _desired_cwd)
-            success = run_command(_desired_command)
-        else:
-            success = run_shell(cleanup_cwd(target.cwd))  # this hangs here until user exits bash
-    else:
-        success = False
+        return run_shell_or_command(cleanup_cwd(target.cwd))
+
+    return with_yakuake_tab(target.yakuakeTabName(), activate)
 
-    if must_restore_yakuake:
-        os.system("rename_yatab.sh Shell")
 
-    return success
+def run_shell_or_command(cwd):
+    global _desired_command, _desired_cwd
+
+    if _desired_command:
+        if _desired_cwd:
+            os.chdir(_desired_cwd)
+        # When --command=foo is passed, we run foo with the desired env, instead of opening an hanging shell
+        if _is_debug:
+            print("Desired Command=" + _desired_command + " ; _desired_cwd=" + _desired_cwd)
+        return run_command(_desired_command)
+
+    return run_shell(cwd)  # this hangs here until user exits bash
 
 
 def editor():
@@ -727,7 +2077,7 @@ def open_editor(filename):
 
 
 def process_arguments():
-    global _switches, _desired_command, _desired_cwd, _silent, _ignore
+    global _switches, _desired_command, _desired_cwd, _silent, _ignore, _profile_filename
     argscopy = _arguments.copy()
 
     for a in argscopy:
@@ -743,6 +2093,10 @@ def process_arguments():
         elif a.startswith('--ignore='):
             _ignore = a.split('--ignore=')[1]
             _arguments.remove(a)
+        elif a.startswith('--profile='):
+            _profile_filename = os.path.abspath(a.split('--profile=')[1])
+            _arguments.remove(a)
+            _switches.append('--profile')
         elif a.startswith('--') and not '--bash-autocomplete-helper' in _arguments:
             print("Invalid switch: " + a)
             sys.exit(-1)
@@ -755,6 +2109,7 @@ def read_default_json():
 
 
 def ask_for_ssh_keys():
+    import subprocess
     try:
         subprocess.check_output(["ssh-add", "-L"]) == 0
     except:
@@ -763,11 +2118,18 @@ def ask_for_ssh_keys():
     return True
 
 
-def first_generic_target(targetName):
+def first_generic_target(targetName, visited=None):
     if targetName in _targets:
+        # Don't loop forever on dependency cycles, plan_target() reports them
+        if visited is None:
+            visited = set()
+        if targetName in visited:
+            return None
+        visited.add(targetName)
+
         target = getTarget(targetName)
         for t in target.uses:
-            result = first_generic_target(t)
+            result = first_generic_target(t, visited)
             if result is not None:
                 return result
         return None
@@ -788,91 +2150,806 @@ def resolve_generic_targets(name):
             target = _targets[targetName]
             if target.isGeneric():
                 target.arg = genericTarget["arg"]
-# -------------------------------------------------------------------------------
 
 
-process_arguments()
+# Resets what resolving a target records
+def start_resolution():
+    global _env_is_cacheable, _depends_on_cwd
+    _env_is_cacheable = True
+    _depends_on_cwd = False
+    _normalized_paths.clear()  # relative paths depend on the cwd
+    _env_changes.clear()
+    _input_variables.clear()
+    del _sourced_scripts[:]
+
+
+# Resets the state that belongs to a single invocation, and parses its arguments
+def start_invocation(argv):
+    global _arguments, _switches, _desired_command, _desired_cwd, _ignore, _is_debug, _silent
+    global _print_env_only, _print_env_to_file, _profile_filename, _env_undo
+
+    _arguments = argv[1:]
+    _switches = []
+    _desired_command = ''
+    _desired_cwd = ''
+    _ignore = ''
+    _is_debug = '--debug' in argv
+    _profile_filename = ''
+    start_resolution()
+    del _on_shell_exit[:]
+    _env_undo = None
+
+    # Processes resolving many targets keep the config loaded
+    for t in _targets.values():
+        t.arg = ""
+
+    process_arguments()
+
+    if '--profile' in _switches and not _profile_filename:
+        _profile_filename = os.path.abspath('use-profile.json')
+
+    _print_env_to_file = '--print-to-file' in _switches
+    _print_env_only = '--print' in _switches or _print_env_to_file
+    # these print shell code too
+    for switch in ['--push', '--pop', '--switch']:
+        if switch in _switches:
+            _print_env_only = True
+    if _print_env_only:
+        _silent = True
 
-if '--config' in _switches or '--configure' in _switches or '--conf' in _switches:
-    open_editor(_use_conf.targetsJsonFilename())
-    sys.exit(1)
 
-read_default_json()
+# Handles the target passed in the command line, once the config is loaded.
+# Returns the exit code, or the target to open a shell for.
+def process_target(argv):
 
-if not read_targets_json():
-    print("Error loading json")
-    sys.exit(1)
+    if len(argv) == 1:
+        print(currentTargetsStr())
+        return -1
 
-if len(sys.argv) == 1:
-    print(currentTargetsStr())
-    sys.exit(-1)
+    targetName = argv[1]
 
-_targetName = sys.argv[1]
+    if "%" in targetName:
+        print("Pass an actual replacement to %")
+        return -1
 
-if "%" in _targetName:
-    print("Pass an actual replacement to %")
-    sys.exit(-1)
+    if '--edit' in _switches:
+        filename = filenameForTarget(Target(targetName))
+        print("Opening editor for " + filename)
+        if not open_editor(filename):
+            print("Error opening editor")
+        return 0
 
+    if '--help' in _switches or '-h' in _switches:
+        printUsage()
+        return 0
 
-if '--edit' in _switches:
-    filename = filenameForTarget(Target(_targetName))
-    print("Opening editor for " + filename)
-    if not open_editor(filename):
-        print("Error opening editor")
-    sys.exit(0)
+    if '--bash-autocomplete-helper' in _switches:
+        wordBeginning = ""
+        if _arguments:
+            wordBeginning = _arguments[0]
 
-if '--help' in _switches or '-h' in _switches:
-    printUsage()
-    sys.exit(0)
+        names = [name for name in _targets if not _targets[name].hidden]
+        print(bash_autocomplete_result(names, wordBeginning))
+        return 0
 
-if '--bash-autocomplete-helper' in _switches:
-    result = ''
-    wordBeginning = ""
-    if _arguments:
-        wordBeginning = _arguments[0]
+    # The daemon can't ask, its client does it instead. Warming doesn't need the keys.
+    if _ask_for_ssh_keys and not _is_daemon and not _is_warming:
+        ask_for_ssh_keys()
 
-    for target in _targets:
-        t = _targets[target]
-        if not t.hidden and target.startswith(wordBeginning):
-            result = result + ' ' + target
+    resolve_generic_targets(targetName)
+    t = getTarget(targetName)
 
-    if wordBeginning.startswith('-'):
-        # Let's only spam the completion with switches if the user already typed -
-        for s in POSSIBLE_SWITCHES:
-            if s.startswith(wordBeginning):
-                result = result + ' ' + s
+    if t.hidden:
+        print("Target is hidden!")
+        return 0
 
-    print(result.strip())
-    sys.exit(0)
+    # --push goes on top of the current env, so --pop can go back to it
+    push = '--push' in _switches
+    reset = '--keep' not in _switches and not push and not t.name.startswith('add-')
 
-if _ask_for_ssh_keys:
-    ask_for_ssh_keys()
+    if '--plan' in _switches:
+        if not print_plan(t, reset):
+            return 1
+        return 0
 
-resolve_generic_targets(_targetName)
-t = getTarget(_targetName)
+    if '--snapshot' in _switches:
+        if not write_snapshot(t, targetName, reset):
+            return 1
+        return 0
 
-if t.hidden:
-    print("Target is hidden!")
-    sys.exit(0)
+    if '--switch' in _switches:
+        if not switch_target(t):
+            return 1
+        return 0
 
-_print_env_to_file = '--print-to-file' in _switches
-_print_env_only = '--print' in _switches or _print_env_to_file
-if _print_env_only:
-    _silent = True
+    # Pushing an active target still pushes a frame, albeit empty, so each --pop undoes one --push
+    if is_sourced(t) and not push:
+        return 0
 
-if is_sourced(t):
-    sys.exit(0)
+    if reset:
+        if not reset_env():  # source default.json
+            return 1
 
-if '--keep' not in _switches and not t.name.startswith('add-'):
-    if not reset_env():  # source default.json
-        sys.exit(1)
+    if _print_env_only:
+        if push:
+            start_env_undo()
+        if not print_target(t):
+            return 1
+        return 0
 
-if _print_env_only:
-    print_target(t)
-    sys.exit(0)
+    return t
 
-# The actual stuff
-result = run_shell_for_target(t)
 
-if not result:
-    sys.exit(1)
+# Switches which a daemon or a snapshot can handle, the others are handled in-process
+DAEMON_SWITCHES = ['--keep', '--silent', '--print', '--print-to-file']
+
+SNAPSHOT_VERSION = 4
+
+
+def snapshot_filename(targetName):
+    import hashlib
+    folder = cache_folder()
+    if not folder:
+        return ""
+
+    # --print converts paths differently, on Windows in bash too, so each gets its own snapshot
+    unix_paths = _print_env_only and isWindows() and isBash()
+    key = json.dumps([use_conf().useFolder(), targetName, '--keep' in _switches, _ignore, _print_env_only, unix_paths])
+    return os.path.join(folder, 'snapshots', hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+
+def file_sha256(filename):
+    import hashlib
+    with open(filename, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+# Resolves target and stores the resulting env, together with everything the result depends on:
+# the config files and scripts that were looked at, the env variables they read, and the cwd if relative
+# paths were resolved. Activations with the same inputs are then served from the snapshot.
+def write_snapshot(target, targetName, reset):
+    global _print_env_only, _silent
+    if not cache_folder():
+        print("Snapshots need a cache folder")
+        return False
+
+    # Opening a shell and --print resolve paths differently, so both get a snapshot, resolved from the same env
+    env = dict(os.environ)
+    (print_env_only, silent) = (_print_env_only, _silent)
+    try:
+        for mode in [False, True]:
+            os.environ.clear()
+            os.environ.update(env)
+            start_resolution()
+            _print_env_only = mode
+            _silent = silent or mode
+            if not write_snapshot_for_mode(target, targetName, reset):
+                return False
+    finally:
+        (_print_env_only, _silent) = (print_env_only, silent)
+
+    print("Wrote snapshot for " + target.displayName())
+    return True
+
+
+def write_snapshot_for_mode(target, targetName, reset):
+    filename = snapshot_filename(targetName)
+    if reset and not reset_env():
+        return False
+
+    export_targets_folder()
+
+    if not source_target(target):
+        return False
+
+    if not _env_is_cacheable:
+        print("Not writing a snapshot, a target in the chain has \"cache_env\": false")
+        return False
+
+    variables = set(_input_variables)
+    variables.update(['SHELL', 'USE_HISTORY_FOLDER'])
+    if not reset:
+        variables.add('USE_CURRENT_TARGETS')
+
+    scripts = {}
+    for script in _sourced_scripts:
+        scripts[script] = file_sha256(script)
+        variables.update(script_input_variables(read_script(script), shellForOS(script)))
+
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'display_name': target.displayName(),
+        'files': _input_files,
+        'scripts': scripts,
+        'variables': {name: _initial_env.get(name) for name in variables},
+        'cwd': os.getcwd() if _depends_on_cwd else None,
+        # Everything resolving set, even to the value the snapshotting shell already had, None for unset
+        'env': _env_changes,
+        'target_cwd': cleanup_cwd(target.cwd),
+        'yakuake_tab_name': target.yakuakeTabName(),
+        'ask_for_ssh_keys': _ask_for_ssh_keys,
+        'exec_shell': _exec_shell
+    }
+
+    if not write_file_atomically(filename, json.dumps(snapshot)):
+        print("Error writing " + filename)
+        return False
+
+    return True
+
+
+# Returns the snapshot for targetName if there's one and its inputs didn't change, otherwise None
+def read_snapshot(targetName):
+    filename = snapshot_filename(targetName)
+    try:
+        with open(filename, 'r') as f:
+            snapshot = json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        return None
+
+    if snapshot['cwd'] is not None and snapshot['cwd'] != os.getcwd():
+        return None
+
+    for (name, value) in snapshot['variables'].items():
+        if _initial_env.get(name) != value:
+            return None
+
+    for (input_file, stamp) in snapshot['files'].items():
+        if file_stamp(input_file) != stamp:
+            return None
+
+    try:
+        for (script, sha) in snapshot['scripts'].items():
+            if file_sha256(script) != sha:
+                return None
+    except OSError:
+        return None
+
+    return snapshot
+
+
+# Activates a target from its snapshot. Returns the exit code, or None if there's no valid snapshot
+def serve_snapshot(argv):
+    global _exec_shell
+    if "%" in argv[1]:
+        return None
+
+    snapshot = read_snapshot(argv[1])
+    if snapshot is None:
+        return None
+
+    if snapshot['ask_for_ssh_keys']:
+        ask_for_ssh_keys()
+
+    if snapshot['display_name'] in currentTargets():
+        return 0
+
+    _exec_shell = snapshot['exec_shell']
+
+    def activate():
+        for (key, value) in snapshot['env'].items():
+            restore_env_variable(key, value)
+
+        if _print_env_only:
+            print_env_changes(snapshot['target_cwd'])
+            return True
+
+        return run_shell_or_command(snapshot['target_cwd'])
+
+    # Printing doesn't open a shell, so the tab keeps its name
+    if not with_yakuake_tab("" if _print_env_only else snapshot['yakuake_tab_name'], activate):
+        return 1
+    return 0
+
+
+def daemon_socket_filename():
+    filename = os.getenv('USE_DAEMON_SOCKET')
+    if filename is not None:
+        return filename
+
+    folder = cache_folder()
+    if not folder:
+        return ""
+    return os.path.join(folder, 'daemon.sock')
+
+
+# Checks for the socket file first, so activations don't import socket when no daemon runs
+def daemon_can_handle(argv):
+    filename = daemon_socket_filename()
+    if not filename or not os.path.exists(filename):
+        return False
+    return handles_activation_only(argv)
+
+
+# Whether argv only asks to activate a target, without any switch needing the config to be loaded
+def handles_activation_only(argv):
+    if len(argv) == 1:
+        return False
+
+    for s in _switches:
+        if s not in DAEMON_SWITCHES:
+            return False
+
+    return True
+
+
+# Sends the request to a running daemon. Returns None if there's none.
+def daemon_request(request):
+    import socket
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(daemon_socket_filename())
+            s.sendall(json.dumps(request).encode('utf-8'))
+            s.shutdown(socket.SHUT_WR)
+            response = read_socket(s)
+    except OSError:
+        return None
+
+    try:
+        return json.loads(response)
+    except ValueError:
+        return None
+
+
+def read_socket(s):
+    chunks = []
+    while True:
+        chunk = s.recv(65536)
+        if not chunk:
+            return b''.join(chunks).decode('utf-8')
+        chunks.append(chunk)
+
+
+# Lets a running daemon resolve the target. Returns the exit code, or None if there's no daemon
+def run_daemon_client(argv):
+    global _exec_shell
+    response = daemon_request({'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ), 'initial_env': _initial_env})
+    if response is None or response.get('fallback'):
+        return None
+
+    if response['ask_for_ssh_keys']:
+        ask_for_ssh_keys()
+
+    sys.stdout.write(response['output'])
+    sys.stderr.write(response['errors'])
+    if response['env_file_lines'] is not None:
+        write_env_file(response['env_file_lines'])
+    if response['status'] is not None:
+        return response['status']
+
+    _exec_shell = response['exec_shell']
+
+    def activate():
+        os.environ.clear()
+        os.environ.update(response['env'])
+        return run_shell_or_command(response['cwd'])
+
+    if not with_yakuake_tab(response['yakuake_tab_name'], activate):
+        return 1
+    return 0
+
+
+_is_daemon = False
+_daemon_responses = {}
+_env_file_lines = None  # what the daemon's --print-to-file would have written
+MAX_DAEMON_RESPONSES = 100
+
+
+# Keeps the parsed targets, the resolved plans and the resulting environments in memory,
+# and serves them to clients through a unix socket
+def run_daemon():
+    global _is_daemon
+    import socket
+
+    filename = daemon_socket_filename()
+    if not filename or not hasattr(socket, 'AF_UNIX'):
+        print("The daemon needs unix sockets and a cache folder (or USE_DAEMON_SOCKET)")
+        return 1
+
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    if os.path.exists(filename):
+        os.remove(filename)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(filename)
+    os.chmod(filename, 0o600)
+    server.listen()
+    _is_daemon = True
+    print("Listening on " + filename, flush=True)
+
+    try:
+        while True:
+            (conn, _) = server.accept()
+            with conn:
+                try:
+                    request = json.loads(read_socket(conn))
+                    response = handle_daemon_request(request)
+                except Exception as e:
+                    print("Error handling request: " + str(e), flush=True)
+                    response = {'fallback': True}
+                conn.sendall(json.dumps(response).encode('utf-8'))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(filename)
+
+    return 0
+
+
+# For processes resolving many targets, like the daemon: forgets the loaded configuration if one of its files changed,
+# so it's loaded again. Returns True if it did.
+def forget_outdated_config():
+    global _generic_targets_index
+
+    # A listing is only good for one invocation
+    _folder_listings.clear()
+
+    if not input_files_changed():
+        return False
+
+    # Some json or script changed, start from scratch
+    _targets.clear()
+    _resolved_target_names.clear()
+    _input_files.clear()
+    _json_files.clear()
+    _generic_targets_index = None
+    return True
+
+
+def ensure_config_loaded():
+    if _targets:
+        return True
+
+    read_default_json()
+    if not read_targets_json():
+        print("Error loading json")
+        _targets.clear()
+        return False
+
+    return True
+
+
+def handle_daemon_request(request):
+    global _initial_env, _env_file_lines
+    import io
+    import hashlib
+    import contextlib
+
+    if forget_outdated_config():
+        _daemon_responses.clear()
+
+    # The loaded config is the one of the daemon's folder
+    if request['env'].get('USE_FOLDER', '') != use_conf().folder_override:
+        return {'fallback': True}
+
+    key = hashlib.sha256(json.dumps([request['argv'], request['cwd'], sorted(request['env'].items()),
+                                     sorted(request['initial_env'].items())]).encode('utf-8')).hexdigest()
+    if key in _daemon_responses:
+        return _daemon_responses[key]
+
+    prepare_invocation_env(request['env'])
+    os.chdir(request['cwd'])
+    start_invocation(request['argv'])
+    _initial_env = request['initial_env']
+
+    response = {'status': None, 'ask_for_ssh_keys': False}
+    output = io.StringIO()
+    errors = io.StringIO()
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(errors):
+        try:
+            if not ensure_config_loaded():
+                sys.exit(1)
+
+            response['ask_for_ssh_keys'] = _ask_for_ssh_keys
+            result = process_target(request['argv'])
+            if isinstance(result, Target):
+                if source_target(result):
+                    response['env'] = dict(os.environ)
+                    response['cwd'] = cleanup_cwd(result.cwd)
+                    response['yakuake_tab_name'] = result.yakuakeTabName()
+                    response['exec_shell'] = _exec_shell
+                else:
+                    response['status'] = 1
+            else:
+                response['status'] = result
+        except SystemExit as e:
+            response['status'] = e.code
+
+    response['output'] = output.getvalue()
+    response['errors'] = errors.getvalue()
+    response['env_file_lines'] = _env_file_lines
+    _env_file_lines = None
+    _config_cache.save()
+
+    if _env_is_cacheable:
+        if len(_daemon_responses) >= MAX_DAEMON_RESPONSES:
+            del _daemon_responses[next(iter(_daemon_responses))]
+        _daemon_responses[key] = response
+
+    return response
+
+
+_is_warming = False
+_config_input_files = {}  # the stamps of the files read to load the config, for snapshots written by --warm
+
+
+# Resolves targets in a pool of processes, filling the config, script delta and snapshot caches.
+# Without arguments every non-hidden target is warmed.
+def warm_targets(names):
+    global _is_warming
+    import io
+    import contextlib
+    import multiprocessing
+    _is_warming = True
+
+    if not cache_folder():
+        print("Warming needs a cache folder")
+        return 1
+
+    if not names:
+        names = [name for name in _targets if not _targets[name].hidden and "%" not in name and name != 'default']
+
+    _config_input_files.update(_input_files)
+
+    # Parse all jsons here, the workers' copies of the config cache are discarded. Forked workers don't load the
+    # targets again, so what loading printed is kept to be reported with the target's failure.
+    load_errors = {}
+    broken = []
+    for name in names:
+        if name in _targets:
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+                loaded = _targets[name].load()
+            load_errors[name] = output.getvalue()
+            if not loaded:
+                broken.append(name)
+    _config_cache.save()
+
+    failed = 0
+    for name in broken:
+        failed += 1
+        print("Failed to warm " + name + ":\n" + load_errors[name].rstrip())
+
+    with multiprocessing.Pool(initializer=init_warm_worker) as pool:
+        for (name, status, output) in pool.imap_unordered(warm_target, [n for n in names if n not in broken]):
+            if status == 0:
+                print("Warmed " + name)
+            else:
+                failed += 1
+                print("Failed to warm " + name + ":\n" + (load_errors.get(name, '') + output).rstrip())
+
+    print("Warmed {} of {} targets".format(len(names) - failed, len(names)))
+    if failed:
+        return 1
+    return 0
+
+
+def init_warm_worker():
+    global _is_warming
+    _is_warming = True
+
+    # Forked workers inherit the loaded config, spawned ones load their own
+    if not _targets:
+        read_default_json()
+        read_targets_json()
+        _config_input_files.update(_input_files)
+
+
+# Runs in a worker, source_target() changes os.environ so each target starts from a copy of the initial env
+def warm_target(name):
+    import io
+    import contextlib
+
+    prepare_invocation_env(_initial_env)
+
+    start_invocation([sys.argv[0], name, '--snapshot', '--silent'])
+
+    # The snapshot only depends on the config and on what this target uses
+    _input_files.clear()
+    _input_files.update(_config_input_files)
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        try:
+            status = process_target([sys.argv[0], name])
+        except SystemExit as e:
+            status = e.code
+        except Exception as e:
+            print(str(e))
+            status = 1
+
+    return (name, status, output.getvalue())
+
+
+# Python API, for tools resolving environments in-process instead of spawning use.py --print:
+#   import use
+#   env = use.resolve_env('myproject', base_env={'PATH': '/usr/bin:/bin', 'HOME': '/home/me'})
+# The config is loaded once and reloaded when one of its files changes, so long-running tools can resolve
+# many targets cheaply. Like use itself, this isn't thread-safe, os.environ is used while sourcing.
+class UseError(Exception):
+    pass
+
+
+class LoadedConfig:
+    # Loads the config now, reports errors with UseError
+    def __init__(self):
+        self.refresh()
+
+    # Loads the config again if one of its files changed since it was loaded
+    def refresh(self):
+        import io
+        import contextlib
+
+        saved_env = dict(os.environ)
+        prepare_invocation_env()
+
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+                forget_outdated_config()
+                loaded = ensure_config_loaded()
+        finally:
+            os.environ.clear()
+            os.environ.update(saved_env)
+
+        _config_cache.save()
+        if not loaded:
+            raise UseError(output.getvalue().strip())
+
+    # Runs function(target) with os.environ set to base_env, as an invocation of "use name" would,
+    # and restores the caller's env afterwards. Output is swallowed, and reported with UseError on failure.
+    def run(self, name, base_env, keep, function):
+        global _initial_env
+        import io
+        import contextlib
+
+        self.refresh()
+
+        saved_env = dict(os.environ)
+        saved_initial_env = _initial_env
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+                prepare_invocation_env(saved_env if base_env is None else base_env)
+                start_invocation(['use', name, '--silent'] + (['--keep'] if keep else []))
+                _initial_env = dict(os.environ)
+
+                if "%" in name:
+                    raise UseError("Pass an actual replacement to %")
+                target = findTarget(name)
+                if target is None:
+                    raise UseError("Unknown target: " + name)
+                resolve_generic_targets(name)
+
+                result = function(target)
+        except SystemExit:
+            raise UseError(output.getvalue().strip())
+        finally:
+            os.environ.clear()
+            os.environ.update(saved_env)
+            _initial_env = saved_initial_env
+
+        if result is None:
+            raise UseError(output.getvalue().strip() or "Error resolving " + name)
+        return result
+
+    def target_names(self, include_hidden=False):
+        self.refresh()
+        return [name for (name, t) in _targets.items() if include_hidden or not t.hidden]
+
+    # Returns what targets.json says about the target, and the file sourced for it
+    def describe_target(self, name):
+        def describe(target):
+            return {'name': target.displayName(), 'description': target.description, 'uses': list(target.uses),
+                    'uses_after': list(target.uses_after), 'cwd': cleanup_cwd(target.cwd), 'hidden': target.hidden,
+                    'file': plan_step_filename(target, target.arg)}
+        return self.run(name, None, False, describe)
+
+    # Returns the targets "use name --plan" would source, in order, with their files
+    def resolve_plan(self, name, base_env=None, keep=False):
+        def plan(target):
+            steps = activation_plan(target, not keep and not target.name.startswith('add-'))
+            if steps is None:
+                return None
+            return [{'target': t.displayName(), 'file': plan_step_filename(t, arg)} for (t, arg) in steps]
+        return self.run(name, base_env, keep, plan)
+
+    # Returns the env a shell opened by "use name" would have, starting from base_env (the current env by default)
+    def resolve_env(self, name, base_env=None, keep=False):
+        def env(target):
+            if not keep and not target.name.startswith('add-') and not reset_env():
+                return None
+            if not source_target(target):
+                return None
+            return dict(os.environ)
+        return self.run(name, base_env, keep, env)
+
+
+_loaded_config = None
+
+
+# The config of the use folder, loaded on first use
+def load_config():
+    global _loaded_config
+    if _loaded_config is None:
+        _loaded_config = LoadedConfig()
+    return _loaded_config
+
+
+def resolve_env(name, base_env=None, keep=False):
+    return load_config().resolve_env(name, base_env, keep)
+
+
+def resolve_plan(name, base_env=None, keep=False):
+    return load_config().resolve_plan(name, base_env, keep)
+
+
+def target_names(include_hidden=False):
+    return load_config().target_names(include_hidden)
+
+
+def describe_target(name):
+    return load_config().describe_target(name)
+
+
+def main():
+    prepare_invocation_env()
+    atexit.register(_config_cache.save)
+
+    start_invocation(sys.argv)
+
+    if '--config' in _switches or '--configure' in _switches or '--conf' in _switches:
+        open_editor(use_conf().targetsJsonFilename())
+        return 1
+
+    if '--daemon' in _switches:
+        return run_daemon()
+
+    if '--pop' in _switches:
+        return pop_env()
+
+    if '--prompt' in _switches:
+        sys.stdout.write(promptStr())
+        return 0
+
+    if handles_activation_only(sys.argv) and cache_folder():
+        status = serve_snapshot(sys.argv)
+        if status is not None:
+            return status
+
+    if daemon_can_handle(sys.argv):
+        status = run_daemon_client(sys.argv)
+        if status is not None:
+            return status
+
+    atexit.register(write_profile)
+
+    with profile_span('config load', 'config'):
+        read_default_json()
+        if not read_targets_json():
+            print("Error loading json")
+            return 1
+
+    if '--warm' in _switches:
+        return warm_targets(_arguments)
+
+    result = process_target(sys.argv)
+    if not isinstance(result, Target):
+        return result
+
+    # The actual stuff
+    if not run_shell_for_target(result):
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())